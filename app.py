@@ -4,16 +4,24 @@ import numpy as np
 import plotly.express as px
 from streamlit_extras.metric_cards import style_metric_cards
 from streamlit_extras.bottom_container import bottom
-from streamlit_extras.dataframe_explorer import dataframe_explorer
 
-from utils import load_gl_transactions_data_from_excel 
+from utils import load_workbook_data, get_data_version, get_statement_cache
+from utils import get_transaction_browser, TRANSACTION_PAGE_ROWS
+from utils import build_income_statement, build_income_statement_lines, build_sales_by_region, build_balance_sheet, build_cash_flow_statement
+from utils import build_llm_context, LLM_CONTEXT_TOKENS
 from utils import print_df_to_dashboard
-from utils import generated_sorted_column 
-from utils import apply_global_filters, sum_filtered_values, filter_df_by_index_values 
+from utils import HIERARCHY_COLUMNS, TIME_GRAINS, get_hierarchy_index
+from utils import KPIService, RATIOS, build_measures, format_measure
 from utils import stylize
 from utils import plot_st_chart, plot_comparison_chart_with_traces
 from utils import percent_formatter_v2
-from utils import ask_from_llm
+from utils import get_llm_service
+from utils import pipeline_stages, measure_stage, DEBUG_PANEL
+
+# the app is the only entry point that writes the stage log (see ACCVIZ_STAGE_LOG)
+pipeline_stages.enable_log()
+# every stage recorded during this script run is grouped under one run id for the debug panel
+pipeline_stages.start_run('app')
 
 # Set Streamlit page configuration
 st.set_page_config(page_title='Financial Dashboard', page_icon=':bar_chart:', layout='wide', initial_sidebar_state='auto')
@@ -37,27 +45,33 @@ with bottom():
 st.title('Financial Dashboard')
 st.write('This dashboard shows the financial performance of ABC Company')
 
-# Load general ledger transactions data
-GL_Master = load_gl_transactions_data_from_excel()
+# Load general ledger transactions data and the report structures
+workbook_data = load_workbook_data()
+
+# Pre-aggregated GL used by the statements; transaction-level detail is only needed in the Transaction Details tab
+GL_Cube = workbook_data['GL_Cube']
+GL_Cube_filter_index = workbook_data['GL_Cube_filter_index']
 
 # Sidebar setup for comparison selection
 st.sidebar.subheader('Comparison')
 comparison_by = st.sidebar.multiselect('Comparison by', ['Region', 'Country'])
 comparison_by.append('Year')  # Ensure 'Year' is always included in the comparison
+time_grain = st.sidebar.selectbox('Time grain', list(TIME_GRAINS))
 
 # Sidebar setup for level of detail selection
 st.sidebar.subheader('Level of Detail')
 level_of_detail = st.sidebar.multiselect('Level of Detail', ['Class', 'SubClass', 'SubClass2', 'Account'])
 if not level_of_detail:
     level_of_detail = ['Class', 'SubClass', 'SubClass2']
-level_of_detail_sorted = sorted(level_of_detail, key=lambda x: ['Class', 'SubClass', 'SubClass2', 'Account'].index(x))
-level_of_detail_sorted = [x + 'Sorted' for x in level_of_detail_sorted]
+level_of_detail_sorted = sorted(level_of_detail, key=lambda x: HIERARCHY_COLUMNS.index(x))
+level_of_detail_sorted = get_hierarchy_index(level_of_detail_sorted)
 
 # Sidebar setup for data filtering
 st.sidebar.subheader('Filter')
-year = st.sidebar.multiselect('Year', GL_Master['Year'].unique())
-region = st.sidebar.multiselect('Region', GL_Master['Region'].unique())
-country = st.sidebar.multiselect('Country', GL_Master['Country'].unique())
+# the options come from the cube's filter index, which is built once per data version, instead of a scan of the GL on every rerun
+year = st.sidebar.multiselect('Year', GL_Cube_filter_index.get_values('Year'))
+region = st.sidebar.multiselect('Region', GL_Cube_filter_index.get_values('Region'))
+country = st.sidebar.multiselect('Country', GL_Cube_filter_index.get_values('Country'))
 
 # with st.sidebar.expander("Chat with your income statement", expanded=True):
 st.sidebar.subheader('Ask questions about your data')
@@ -77,224 +91,185 @@ with st.sidebar.form(key='context_form'):
 
 filtered_values = (year, region, country)
 
-profit_and_loss_tab, balance_sheet_tab, cash_flow_tab, transaction_details_tab, soce_tab = st.tabs(["P&L Report", "Balance Sheet", "Cash Flow Statement", "Transaction Details", "Changes in Equity Statement"])
-
-with transaction_details_tab:
-    # Filter data based on sidebar selections
-    Filtered_GL_Master = apply_global_filters(GL_Master, *filtered_values)    
-    st.dataframe(dataframe_explorer(Filtered_GL_Master, case=False))
-
-
-with profit_and_loss_tab:
-    # Filter data based on sidebar selections
-    Filtered_GL_Master = apply_global_filters(GL_Master, *filtered_values)
-
-    # Load and merge P&L structure, then sort and display the P&L report
-    pnl_structure = pd.read_excel('data/Data.xlsx', sheet_name='PnL Structure')
-    PnL_GL_Master = pd.merge(Filtered_GL_Master, pnl_structure, left_on='Account_key', right_on='Account_key', how='inner', suffixes=('', ''))
-    
-    # Generating sorted columns based on the sort key in the structure 
-    PnL_GL_Master = generated_sorted_column(PnL_GL_Master, ['Account', 'SubClass', 'SubClass2', 'Class'])
-    
-    income_statement_df = pd.pivot_table(PnL_GL_Master, index= level_of_detail_sorted, values='Amount', columns=comparison_by, 
-                                aggfunc='sum', margins=True, margins_name='Total'
-                            ).sort_values(by=level_of_detail_sorted, ascending=True)
-
-    # removing the grand total row at the bottom
-    income_statement_df = income_statement_df.iloc[:-1, :]
-
-    # calculating the KPIs
-    sales_ttd = apply_global_filters(GL_Master, region=region, country=country, year=[])
-    sales_ttd = sum_filtered_values(sales_ttd, filter_maps={"SubClass": ['Sales']})
-
-    current_year = max(year or ["2020"])
-    prv_year = str(int(current_year) - 1)  
-
-    sales_ftp = apply_global_filters(GL_Master, region=region, country=country, year=[current_year])
-    sales_ftp = sum_filtered_values(sales_ftp, filter_maps={"SubClass": ['Sales']})
-    
-    prv_sales_ftp = apply_global_filters(GL_Master, region=region, country=country, year=[prv_year])
-    prv_sales_ftp = sum_filtered_values(prv_sales_ftp, filter_maps={"SubClass": ['Sales']})
-    diff_sales_ftp = sales_ftp - prv_sales_ftp
-
-    col1, col2 = profit_and_loss_tab.columns([1, 5])
-    col1.write("### Ratio Analysis")
-    with col1.container(height=700):
-        st.metric("Total Sales TTD", stylize(sales_ttd))
-        st.metric("Total Sales FTP", stylize(sales_ftp), delta=stylize(diff_sales_ftp))
-        
-    style_metric_cards(background_color = "#fff", border_left_color="#f75")
-
-    col2.write("### Report")
-    with col2.container():
-        print_df_to_dashboard(income_statement_df)
-        income_statement_df = income_statement_df.iloc[:, :-1] # this is done to remove the total at column level as it is not useful in this report. 
-    
-    context_income_statement = income_statement_df.reset_index().to_markdown(index=False)
-    context_income_statement = context_income_statement.replace("""<span style="display:none;">""", "").replace("""</span>""", "")
-    context_income_statement = context_income_statement.replace("""<i>""", "").replace("""</i>""", "")
-        
+# only the selected tab is computed; switching tabs reruns the script so the newly opened tab can build its statement
+data_version = get_data_version()
+profit_and_loss_tab, balance_sheet_tab, cash_flow_tab, transaction_details_tab, soce_tab = st.tabs(["P&L Report", "Balance Sheet", "Cash Flow Statement", "Transaction Details", "Changes in Equity Statement"], key='statement_tab', on_change='rerun')
+
+if transaction_details_tab.open:
+    with transaction_details_tab, measure_stage('Transaction Details tab'):
+        # filtering, sorting and paging run on the server; only the visible page is sent to the browser
+        transactions = get_transaction_browser(data_version)
+
+        column_filters = {}
+        filter_columns = st.multiselect('Filter dataframe on', transactions.columns, key='transaction_filter_columns')
+        for column in filter_columns:
+            domain_type, domain = transactions.get_column_domain(column)
+            if domain_type == 'values':
+                column_filters[column] = st.multiselect(f'Values for {column}', domain, key=f'transaction_filter:{column}')
+            elif domain_type == 'range' and pd.api.types.is_datetime64_any_dtype(transactions.df[column]):
+                date_range = st.date_input(f'Values for {column}', value=(domain[0].date(), domain[1].date()), key=f'transaction_filter:{column}')
+                if len(date_range) == 2:
+                    column_filters[column] = (pd.Timestamp(date_range[0]), pd.Timestamp(date_range[1]) + pd.Timedelta(days=1) - pd.Timedelta(microseconds=1))
+            elif domain_type == 'range':
+                column_filters[column] = st.slider(f'Values for {column}', float(domain[0]), float(domain[1]), (float(domain[0]), float(domain[1])), key=f'transaction_filter:{column}')
+            else:
+                column_filters[column] = st.text_input(f'Substring in {column}', key=f'transaction_filter:{column}')
+
+        sort_col, direction_col = st.columns([3, 1])
+        sort_by = sort_col.selectbox('Sort by', [None] + transactions.columns, format_func=lambda column: 'Ledger order' if column is None else column, key='transaction_sort_by')
+        descending = direction_col.toggle('Descending', key='transaction_sort_descending')
+
+        positions = transactions.query(filtered_values, column_filters, sort_by=sort_by, ascending=not descending)
+        page_count = max(-(-len(positions) // TRANSACTION_PAGE_ROWS), 1)
+
+        # a narrower filter can leave the remembered page past the end
+        if st.session_state.get('transaction_page', 1) > page_count:
+            st.session_state['transaction_page'] = 1
+        page_col, summary_col = st.columns([1, 3])
+        page = page_col.number_input(f'Page (of {page_count:,})', min_value=1, max_value=page_count, key='transaction_page')
+        summary_col.write(f"{len(positions):,} transactions, total amount {stylize(transactions.df['Amount'].iloc[positions].sum())}")
+        st.dataframe(transactions.get_page(positions, page), hide_index=True)
+
+        csv_col, parquet_col = st.columns(2)
+        csv_col.download_button('Download CSV', data=lambda: transactions.export(positions, 'csv'), file_name='transactions.csv', mime='text/csv')
+        parquet_col.download_button('Download Parquet', data=lambda: transactions.export(positions, 'parquet'), file_name='transactions.parquet', mime='application/octet-stream')
+
+
+if profit_and_loss_tab.open:
+    with profit_and_loss_tab, measure_stage('P&L Report tab'):
+        income_statement_df, pnl_calculated_labels = build_income_statement(data_version, filtered_values, level_of_detail_sorted, comparison_by, time_grain)
+
+        # calculating the KPIs
+        with measure_stage('kpis', len(GL_Cube)):
+            kpis = KPIService(GL_Cube, region=region, country=country, filter_index=GL_Cube_filter_index)
+        sales_ttd = kpis.ttd('Sales')
+
+        current_year = max(year or [2020])
+        prv_year = current_year - 1
+
+        sales_ftp = kpis.ftp('Sales', current_year)
+        prv_sales_ftp = kpis.ftp('Sales', prv_year)
+        diff_sales_ftp = sales_ftp - prv_sales_ftp
+
+        col1, col2 = profit_and_loss_tab.columns([1, 5])
+        col1.write("### Ratio Analysis")
+        with col1.container(height=700):
+            st.metric("Total Sales TTD", stylize(sales_ttd))
+            st.metric("Total Sales FTP", stylize(sales_ftp), delta=stylize(diff_sales_ftp))
+
+            # every ratio comes from the same memoized measure table, so more ratios cost no extra aggregation
+            measures, measure_units = build_measures(data_version, region, country)
+            for ratio in RATIOS:
+                ratio_value = measures[ratio].get(current_year, np.nan)
+                prv_ratio_value = measures[ratio].get(prv_year, np.nan)
+                ratio_delta = None if pd.isna(ratio_value) or pd.isna(prv_ratio_value) else format_measure(ratio_value - prv_ratio_value, measure_units[ratio])
+                st.metric(ratio, format_measure(ratio_value, measure_units[ratio]), delta=ratio_delta)
+            
+        style_metric_cards(background_color = "#fff", border_left_color="#f75")
 
-    with st.expander("### Quick Insights",  expanded=True):
-        income_statement_df_for_analysis = pd.pivot_table(PnL_GL_Master, index= ['ClassSorted', 'SubClassSorted', 'SubClass2Sorted'], values='Amount', columns=['Year'], 
-                                aggfunc='sum'
-                            ).sort_values(by=['ClassSorted', 'SubClassSorted', 'SubClass2Sorted'], ascending=True)
+        col2.write("### Report")
+        with col2.container():
+            print_df_to_dashboard(income_statement_df, calculated_labels=pnl_calculated_labels, key='income_statement')
 
-        if len(income_statement_df_for_analysis.index.names) > 0:
-            income_statement_df_for_analysis.index.names = [x.replace('Sorted', '') if x else None for x in income_statement_df_for_analysis.index.names]    
-    
+        with st.expander("### Quick Insights",  expanded=True):
+            statement_lines = build_income_statement_lines(data_version, filtered_values)
 
-        gross_profit_df = filter_df_by_index_values(income_statement_df_for_analysis, 'Class', ['Gross Profit'])
-        sales_df = filter_df_by_index_values(income_statement_df_for_analysis, 'SubClass', ['Sales'])
-        net_profit_df = filter_df_by_index_values(income_statement_df_for_analysis, 'Class', ['Net Profit'])
-        ebitda_df = filter_df_by_index_values(income_statement_df_for_analysis, 'SubClass', ['Sales', 'Cost of Sales', 'Operating Expenses'])
+            gross_profit_df = statement_lines.loc[['Gross Profit']].reset_index(drop=True)
+            sales_df = statement_lines.loc[['Sales']].reset_index(drop=True)
+            net_profit_df = statement_lines.loc[['Net Profit']].reset_index(drop=True)
+            ebitda_df = statement_lines.loc[['EBITDA']].reset_index(drop=True)
 
-        cht1, cht2, cht3 = st.columns(3)
+            cht1, cht2, cht3 = st.columns(3)
 
-        with cht1: 
-            st.write("#### Gross Profit Margin Over the Period")
-            gp_margin = gross_profit_df / sales_df * 100 
-            gp_margin.index = ['Gross Profit %']
-            # print_df_to_dashboard(gp_margin, formatter=percent_formatter_v2)
-            plot_st_chart(['Year'], gp_margin, 'Gross Profit %', 'line', width=500, height=300 )
-        
-        with cht2:
-            st.write("#### Net Profit Margin Over the Period")
-            np_margin = net_profit_df / sales_df * 100 
-            np_margin.index = ['Net Profit %']
-            # print_df_to_dashboard(np_margin, formatter=percent_formatter_v2)            
-            plot_st_chart(['Year'], np_margin, 'Net Profit %', 'line', width=500, height=300)
-        
-        with cht3:
-            st.write(("#### EBITDA Over the Period"))
-            ebitda_df.index = ['EBITDA']
-            # print_df_to_dashboard(ebitda_df)
-            plot_st_chart(['Year'], ebitda_df, 'EBITDA', 'bar', width=500, height=300)
-        
+            with cht1: 
+                st.write("#### Gross Profit Margin Over the Period")
+                gp_margin = gross_profit_df / sales_df * 100 
+                gp_margin.index = ['Gross Profit %']
+                # print_df_to_dashboard(gp_margin, formatter=percent_formatter_v2)
+                plot_st_chart(['Year'], gp_margin, 'Gross Profit %', 'line', width=500, height=300 )
+            
+            with cht2:
+                st.write("#### Net Profit Margin Over the Period")
+                np_margin = net_profit_df / sales_df * 100 
+                np_margin.index = ['Net Profit %']
+                # print_df_to_dashboard(np_margin, formatter=percent_formatter_v2)            
+                plot_st_chart(['Year'], np_margin, 'Net Profit %', 'line', width=500, height=300)
+            
+            with cht3:
+                st.write(("#### EBITDA Over the Period"))
+                ebitda_df.index = ['EBITDA']
+                # print_df_to_dashboard(ebitda_df)
+                plot_st_chart(['Year'], ebitda_df, 'EBITDA', 'bar', width=500, height=300)
+            
 
-    with st.expander("### Breakdown by Region", expanded=True):
-        sales_df = apply_global_filters(GL_Master, region=region, country=country, year=[])
-        sales_df = sales_df[sales_df['SubClass'] == 'Sales']
-        sales_df = pd.pivot_table(sales_df, index=['Region', 'Year'], values='Amount', aggfunc='sum')
-        sales_df = sales_df.reset_index()
-        # st.write(sales_df)
-        fig = px.bar(sales_df, x='Year', y='Amount', color='Region', barmode='group')
-
-        # Update layout for better visualization
-        fig.update_layout(
-            title='Sales Breakdown by Year and Region',
-            xaxis_title='Year',
-            yaxis_title='Sales',
-            height=400,
-            bargap=0.4
-        )
-
-        # Display the chart in Streamlit
-        st.plotly_chart(fig)        
+        with st.expander("### Breakdown by Region", expanded=True):
+            sales_df = build_sales_by_region(data_version, region, country)
+            # st.write(sales_df)
+            fig = px.bar(sales_df, x='Year', y='Amount', color='Region', barmode='group')
+
+            # Update layout for better visualization
+            fig.update_layout(
+                title='Sales Breakdown by Year and Region',
+                xaxis_title='Year',
+                xaxis_type='category',
+                yaxis_title='Sales',
+                height=400,
+                bargap=0.4
+            )
+
+            # Display the chart in Streamlit
+            st.plotly_chart(fig)        
         
 
-with balance_sheet_tab:
-    # Load balance sheet structure from an Excel file
-    bs_structure = pd.read_excel('data/Data.xlsx', sheet_name='BS Structure')
-    
-    # Merge the loaded balance sheet structure with the GL_Master data
-    BS_GL_Master = pd.merge(GL_Master, bs_structure, left_on='Account_key', right_on='Account_key', how='inner', suffixes=('', ''))
-
-    # generated sorted columns to ensure rows appear in correct order 
-    BS_GL_Master = generated_sorted_column(BS_GL_Master, ['Account', 'SubClass', 'SubClass2', 'Class'])
-
-    # generate a simple FTP balance
-    BS_GL_Group2 = BS_GL_Master.groupby(['ClassSorted', 'SubClassSorted', 'SubClass2Sorted', 'AccountSorted', 'Region', 'Country', 'Year']).agg({'Amount': 'sum'}).reset_index()
-    
-    # move the year to columns 
-    crosstab_result = pd.crosstab(
-        index=[BS_GL_Group2['ClassSorted'], BS_GL_Group2['SubClassSorted'], BS_GL_Group2['SubClass2Sorted'], BS_GL_Group2['AccountSorted'], BS_GL_Group2['Region'], BS_GL_Group2['Country'],],
-        columns=BS_GL_Group2['Year'], values=BS_GL_Group2['Amount'], aggfunc='sum')
-
-    # generate a cumsum to attain a balance for year 
-    balance_summary = crosstab_result.cumsum(axis=1)
-    balance_summary = balance_summary.stack().reset_index(name='CumulativeSum')
+if balance_sheet_tab.open:
+    with balance_sheet_tab, measure_stage('Balance Sheet tab'):
+        BS_GL_Group3, bs_calculated_labels = build_balance_sheet(data_version, filtered_values, level_of_detail_sorted, comparison_by, time_grain)
 
-    # apply global filters 
-    Filtered_Balance_Summary = apply_global_filters(balance_summary, *filtered_values)
+        print_df_to_dashboard(BS_GL_Group3, st, calculated_labels=bs_calculated_labels, key='balance_sheet')
 
-    # prepare the balance sheet report 
-    BS_GL_Group3 = pd.pivot_table(Filtered_Balance_Summary, index=level_of_detail_sorted, values='CumulativeSum', columns=comparison_by, aggfunc='sum')
-
-    print_df_to_dashboard(BS_GL_Group3, st)
-
-    context_balance_sheet = "balance sheet missing, so do not generate response"
-
-
-with cash_flow_tab:
-    cf_structure = pd.read_excel('data/Data.xlsx', sheet_name='CF Structure')
-    CF_GL_Master = pd.merge(GL_Master, cf_structure, left_on='Account_key', right_on='Account_key', how='inner', suffixes=('', '')) 
-    CF_GL_Master = generated_sorted_column(CF_GL_Master, ['SubType'])
-    CF_GL_Master['Sign'] = np.where(CF_GL_Master['Amount'] > 0, 'Positive', 'Negative') 
-
-    cash_flow_df = pd.pivot_table(CF_GL_Master, index= ['Type','SubTypeSorted','ValueType', 'Region', 'Country', 'Sign', 'Account'], values='Amount', columns='Year', aggfunc='sum'
-                                  ).sort_values(by=['SubTypeSorted'], ascending=True)
-    
-    cash_flow_df = cash_flow_df.reset_index()      
-
-    years_in_data = GL_Master['Year'].unique()
-
-    transformed_cf_df = pd.DataFrame()
-    for _, row in cash_flow_df.iterrows():
-        prv_year_value = 0
-        for yr in years_in_data:
-            current_year_value = 0
-
-            if row['ValueType'] == 'All_FTP':
-                current_year_value += row[yr]
-            elif row['ValueType'] == 'All_FTP_CS':
-                current_year_value -= row[yr]
-            elif row['ValueType'] == 'All_FTP_Negative' and row['Sign'] == 'Negative':
-                current_year_value += row[yr]
-            elif row['ValueType'] == 'All_FTP_Positive_CS' and row['Sign'] == 'Positive':
-                current_year_value -= row[yr]
-            elif row['ValueType'] == 'All_FTP_Negative_CS' and row['Sign'] == 'Negative':
-                current_year_value -= row[yr]
-            elif row['ValueType'] == 'All_FTP_Positive' and row['Sign'] == 'Positive':
-                current_year_value += row[yr]
-            elif row['ValueType'] == 'Closing_balance':
-                current_year_value += row[yr] + prv_year_value
-                prv_year_value = current_year_value
-            elif row['ValueType'] == 'Opening_balance':
-                current_year_value = prv_year_value
-                prv_year_value = row[yr] + prv_year_value
-            
-            row[yr] = current_year_value
-        transformed_cf_df = pd.concat([transformed_cf_df, row], axis=1)
-    
-    transformed_cf_df = transformed_cf_df.transpose() 
-    transformed_cf_df = pd.melt(transformed_cf_df, id_vars=['Type','SubTypeSorted','ValueType', 'Region', 'Country', 'Sign', 'Account'], var_name='Year', value_name='Amount')
-    
-    Filtered_CF = apply_global_filters(transformed_cf_df, *filtered_values)
-    
-    Filtered_CF = pd.pivot_table(Filtered_CF, index= ['Type','SubTypeSorted'], values= ['Amount'], columns=comparison_by, aggfunc='sum'
-                                 ).sort_values(by=['SubTypeSorted'], ascending=True)
 
-    print_df_to_dashboard(Filtered_CF, st)
+if cash_flow_tab.open:
+    with cash_flow_tab, measure_stage('Cash Flow Statement tab'):
+        Filtered_CF, cf_calculated_labels = build_cash_flow_statement(data_version, filtered_values, comparison_by, time_grain)
 
-    context_cash_flow_statement = "cash flow missing, so do not generate response"
+        print_df_to_dashboard(Filtered_CF, st, calculated_labels=cf_calculated_labels, key='cash_flow_statement')
 
 if q_submit_button:
-    context = ""
-    if include_income_statement:
-        context += "\n#### Income Statement\n" + context_income_statement + "\n"
-    if include_balance_sheet:
-        context += "\n#### Balance Sheet\n" + context_balance_sheet + "\n"
-    if include_cashflow:
-        context += "\n#### Cashflow Statement\n" +context_cash_flow_statement + "\n"
+    # the statement summaries are only built for the statements ticked in the form, within a shared token budget, and are memoized per filter state
+    statements = [name for name, included in [('Income Statement', include_income_statement), ('Balance Sheet', include_balance_sheet), ('Cash Flow', include_cashflow)] if included]
+    if statements:
+        statements.append('Key Ratios')
+    with measure_stage('llm_context'):
+        context = f"Filters: year {year or 'all'}, region {region or 'all'}, country {country or 'all'}, by {time_grain.lower()}\n\n"
+        context += "\n\n".join(build_llm_context(data_version, statement, filtered_values, time_grain, LLM_CONTEXT_TOKENS // len(statements)) for statement in statements)
 
     # Main content area
     with st.sidebar.expander("Answer", expanded=True):
         # Build the query with context
         query = f""" Try your best to answer the question based on available data, this is for teaching purpose only so assume some data that is not mentioned. \n### context: \n{context}\n\n### question: \n{question} \n ###""" 
 
-        # # Display or use the query for LLM interaction
-        # st.write(query)
-        # Uncomment the following lines to integrate with an LLM
-        response = ask_from_llm(query=query)
-        st.write(response)
\ No newline at end of file
+        # the answer is streamed as the model writes it; repeated questions come from the on-disk cache
+        llm_service = get_llm_service()
+        try:
+            with measure_stage('llm_answer'):
+                st.write_stream(llm_service.stream_answer(query))
+        except TimeoutError as error:
+            st.error(str(error))
+        llm_stats = llm_service.stats()
+        st.caption(f"{llm_stats['backend']} · {llm_stats['hit_rate']:.0%} cache hits over {llm_stats['requests']} questions · p50 {llm_stats['p50_ms']:.0f} ms")
+
+# shown last so the counters include the statements built on this run
+with st.sidebar.expander('Statement cache'):
+    cache_stats = get_statement_cache().stats()
+    st.caption(f"{cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['evictions']} evictions · {cache_stats['entries']} statements, {cache_stats['size_mb']:.1f} MB")
+
+# where this run spent its time, stage by stage; nested stages are indented under the stage that called them
+if DEBUG_PANEL or st.query_params.get('debug') == '1':
+    with st.sidebar.expander('Pipeline timings'):
+        run_stages = pd.DataFrame(pipeline_stages.get_run(), columns=['stage', 'depth', 'started_at', 'seconds', 'rows_in', 'rows_out', 'memory_mb', 'cached'])
+        run_stages = run_stages.sort_values('started_at')
+        run_stages['stage'] = ['\u2003' * depth + stage for stage, depth in zip(run_stages['stage'], run_stages['depth'])]
+        st.caption(f"{len(run_stages)} stages, {run_stages.loc[run_stages['depth'] == 0, 'seconds'].sum():.2f}s at the top level")
+        st.dataframe(run_stages.drop(columns=['depth', 'started_at']), hide_index=True)
+        st.caption('Slowest stages over recent runs')
+        st.dataframe(pipeline_stages.summarize().head(10))
@@ -0,0 +1,321 @@
+import os
+import sys
+import json
+import time
+import argparse
+import functools
+import platform
+import resource
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from utils import DATA_FILE_PATH, WORKBOOK_SHEETS, get_cache_paths, get_data_version, rebuild_data_cache, _load_workbook_data
+from utils import apply_global_filters, get_hierarchy_index, format_statement_index, render_statement_html
+from utils import get_statement_cache, build_income_statement, build_balance_sheet, build_cash_flow_statement, build_measures, KPIService
+
+
+# rows per generated GL chunk, which bounds the generator's memory use
+GENERATOR_CHUNK_ROWS = 1000000
+
+# lines per GL scale of the default benchmark run
+BENCHMARK_SCALES = [10000, 100000, 1000000]
+
+# a stage this much slower than in the baseline results is reported as a regression
+REGRESSION_TOLERANCE = 1.25
+
+
+@functools.lru_cache(maxsize=2)
+def read_template(template_path=DATA_FILE_PATH):
+    # parsing the template workbook takes longer than generating a small ledger, so it is read once per run
+    return pd.read_excel(template_path, sheet_name=WORKBOOK_SHEETS)
+
+
+def generate_dimensions(template, accounts, territories, start_year, years):
+    """
+    Scales the dimension and structure sheets of a template workbook up to the requested size.
+
+    Extra accounts are copies of the template's accounts, keeping the COA names that the measures
+    and ratios select accounts by, with their rows in the PnL, BS and CF
+    structures repeated under the new Account_key, so every statement keeps its layout; extra
+    territories are numbered copies of the template's countries in the same regions.
+
+    Returns:
+    - tuple: (the generated sheets, {template Account_key: its Account_keys in the generated COA}).
+    """
+    coa = template['COA']
+    copies = [coa]
+    step = int(coa['Account_key'].max()) + 10
+    copy_count = int(np.ceil(accounts / len(coa)))
+    for copy in range(1, copy_count):
+        extra = coa.iloc[:accounts - len(coa) * copy].copy()
+        extra['Account_key'] = extra['Account_key'] + step * copy
+        copies.append(extra)
+    generated_coa = pd.concat(copies, ignore_index=True)
+    template_key = generated_coa['Account_key'] % step
+    account_copies = generated_coa.groupby(template_key)['Account_key'].apply(np.array).to_dict()
+
+    sheets = {'COA': generated_coa}
+    for structure in ['PnL Structure', 'BS Structure', 'CF Structure']:
+        rows = template[structure]
+        structure_rows = pd.concat([rows.assign(Account_key=rows['Account_key'] + step * copy) for copy in range(copy_count)], ignore_index=True)
+        sheets[structure] = structure_rows[structure_rows['Account_key'].isin(generated_coa['Account_key'])]
+
+    territory = template['Territory']
+    generated_territory = pd.DataFrame({
+        'Territory_key': np.arange(1, territories + 1),
+        'Country': [territory['Country'].iloc[key % len(territory)] + ('' if key < len(territory) else f" {key // len(territory) + 1}") for key in range(territories)],
+        'Region': [territory['Region'].iloc[key % len(territory)] for key in range(territories)],
+    })
+    sheets['Territory'] = generated_territory
+
+    dates = pd.date_range(f'{start_year}-01-01', f'{start_year + years - 1}-12-31', freq='D')
+    sheets['Calendar'] = pd.DataFrame({'Date': dates, 'Year': dates.year, 'Quarter': 'Qtr ' + dates.quarter.astype('str'),
+                                       'Month': dates.strftime('%b'), 'Day': dates.strftime('%a')})
+    return sheets, account_copies
+
+
+def generate_gl_chunk(template_gl, entries, rng, account_copies, territories, start_year, years, first_entry):
+    """
+    Generates GL lines by resampling whole entries of the template GL.
+
+    Each sampled entry keeps its lines' accounts (or copies of them), details and day of the year,
+    and gets a random territory, year and scale factor, so the generated ledger has the same shape
+    and sign conventions as the template at any size.
+    """
+    lengths = entries['length'][entries['sampled']]
+    starts = entries['start'][entries['sampled']]
+    lines = np.repeat(starts, lengths) + (np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths))
+    line_entry = np.repeat(np.arange(len(lengths)), lengths)
+
+    entry_year = rng.integers(start_year, start_year + years, len(lengths))
+    entry_territory = rng.integers(1, territories + 1, len(lengths))
+    entry_scale = rng.lognormal(0, 0.25, len(lengths))
+
+    day_of_year = template_gl['day_of_year'][lines]
+    year = entry_year[line_entry]
+    year_start = (year - 1970).astype('datetime64[Y]').astype('datetime64[D]')
+    year_length = np.where((year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0)), 366, 365)
+    dates = year_start + np.minimum(day_of_year, year_length - 1).astype('timedelta64[D]')
+
+    template_accounts = template_gl['Account_key'][lines]
+    accounts = template_accounts.copy()
+    for template_account, copies in account_copies.items():
+        mask = template_accounts == template_account
+        if len(copies) > 1 and mask.any():
+            accounts[mask] = rng.choice(copies, mask.sum())
+
+    return pd.DataFrame({
+        'EntryNo': first_entry + line_entry + template_gl['entry_line'][lines],
+        'Date': dates.astype('datetime64[us]'),
+        'Territory_key': entry_territory[line_entry],
+        'Account_key': accounts,
+        'Details': template_gl['Details'][lines],
+        'Amount': np.round(template_gl['Amount'][lines] * entry_scale[line_entry]),
+    })
+
+
+def generate_synthetic_ledger(output_dir, lines, accounts=None, territories=None, years=3, start_year=2018, seed=0,
+                              template_path=DATA_FILE_PATH, chunk_rows=GENERATOR_CHUNK_ROWS):
+    """
+    Writes a synthetic workbook and GL export with the same schema as the template workbook.
+
+    The workbook holds the COA, Territory, Calendar and structure sheets; the GL goes to a
+    Parquet file next to it, written chunk by chunk, so ledgers far beyond Excel's row limit can
+    be generated in bounded memory. Load it with `rebuild_data_cache(workbook, gl_source)`.
+
+    Parameters:
+    - output_dir (str): Folder to write 'Data.xlsx' and 'GL.parquet' to.
+    - lines (int): Number of GL lines, e.g. 10_000 to 50_000_000.
+    - accounts (int): Number of accounts, at least the template's; None keeps the template's.
+    - territories (int): Number of territories; None keeps the template's.
+    - years (int), start_year (int): The years the postings are spread over.
+    - seed (int): Random seed, so the same arguments give the same ledger.
+    - template_path (str): The workbook whose sheets and entries are scaled up.
+    - chunk_rows (int): GL lines generated and written at a time.
+
+    Returns:
+    - tuple: (workbook path, GL Parquet path).
+    """
+    template = read_template(template_path)
+    accounts = max(accounts or 0, len(template['COA']))
+    territories = territories or len(template['Territory'])
+    sheets, account_copies = generate_dimensions(template, accounts, territories, start_year, years)
+
+    # template entries are the lines sharing a territory and whole EntryNo, in ledger order
+    gl = template['GL']
+    entry_key = gl['Territory_key'].astype('int64') * 10**9 + np.floor(gl['EntryNo']).astype('int64')
+    starts = np.flatnonzero(np.r_[True, entry_key.to_numpy()[1:] != entry_key.to_numpy()[:-1]])
+    template_gl = {
+        'Account_key': gl['Account_key'].to_numpy(),
+        'Details': gl['Details'].to_numpy(dtype='object'),
+        'Amount': gl['Amount'].to_numpy(dtype='float64'),
+        'entry_line': np.round(gl['EntryNo'] - np.floor(gl['EntryNo']), 3).to_numpy(),
+        'day_of_year': gl['Date'].dt.dayofyear.to_numpy() - 1,
+    }
+    entries = {'start': starts, 'length': np.diff(np.r_[starts, len(gl)])}
+
+    os.makedirs(output_dir, exist_ok=True)
+    workbook_path = os.path.join(output_dir, 'Data.xlsx')
+    gl_path = os.path.join(output_dir, 'GL.parquet')
+    with pd.ExcelWriter(workbook_path) as writer:
+        for name, sheet in sheets.items():
+            sheet.to_excel(writer, sheet_name=name, index=False)
+
+    rng = np.random.default_rng(seed)
+    written = 0
+    writer = None
+    try:
+        while written < lines:
+            # sample enough entries for the chunk, then trim the last one's surplus lines
+            wanted = min(chunk_rows, lines - written)
+            sampled = rng.integers(0, len(starts), int(wanted / entries['length'].mean()) + 1)
+            sampled = sampled[:np.searchsorted(np.cumsum(entries['length'][sampled]), wanted) + 1]
+            chunk = generate_gl_chunk(template_gl, {**entries, 'sampled': sampled}, rng, account_copies, territories, start_year, years, written + 1).iloc[:wanted]
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(gl_path, table.schema)
+            writer.write_table(table)
+            written += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    return workbook_path, gl_path
+
+
+def time_stage(results, name, run, rows_in=None):
+    """
+    Runs one benchmark stage, recording its wall time, peak traced memory and output rows in results.
+    """
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    output = run()
+    seconds = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    result = output[0] if isinstance(output, tuple) else output
+    rows_out = len(result) if isinstance(result, (pd.DataFrame, pd.Series)) else None
+    results[name] = {'seconds': seconds, 'peak_mb': peak / 2**20, 'rows_in': rows_in, 'rows_out': rows_out}
+    print(f"  {name:<22} {seconds:9.3f}s {peak / 2**20:10.1f} MB", file=sys.stderr)
+    return output
+
+
+def run_benchmark_scale(workbook_path, gl_path, chunk_size):
+    """
+    Times each stage of the statement pipeline on one generated ledger, from a cold cache.
+
+    Returns:
+    - dict: {stage: {'seconds', 'peak_mb', 'rows_in', 'rows_out'}}.
+    """
+    stages = {}
+    cache_dir = get_cache_paths(workbook_path)['dir']
+    for name in os.listdir(cache_dir) if os.path.isdir(cache_dir) else []:
+        os.remove(os.path.join(cache_dir, name))
+
+    time_stage(stages, 'rebuild_cache', lambda: rebuild_data_cache(workbook_path, gl_path, chunk_size))
+    data_version = get_data_version(workbook_path, gl_path, None, chunk_size)
+    workbook_data = time_stage(stages, 'load', lambda: _load_workbook_data(*data_version))
+    gl_master = workbook_data['GL_Master']
+    region = [gl_master['Region'].iloc[0]]
+    year = [int(gl_master['Year'].max())]
+
+    time_stage(stages, 'filter_scan', lambda: apply_global_filters(gl_master, year, region, []), len(gl_master))
+    time_stage(stages, 'filter_indexed', lambda: apply_global_filters(gl_master, year, region, [], workbook_data['GL_Master_filter_index']), len(gl_master))
+
+    # every statement is built from an empty statement cache, as on the first request for it
+    filters = ([], [], [])
+    statement_cache = get_statement_cache()
+    level_of_detail = get_hierarchy_index(['Class', 'SubClass', 'SubClass2', 'Account'])
+    cube_rows = len(workbook_data['GL_Cube'])
+    statement_cache.clear()
+    income_statement, _ = time_stage(stages, 'income_statement', lambda: build_income_statement(data_version, filters, level_of_detail, ['Region', 'Year']), cube_rows)
+    statement_cache.clear()
+    time_stage(stages, 'balance_sheet', lambda: build_balance_sheet(data_version, filters, level_of_detail, ['Region', 'Year']), len(workbook_data['GL_Balances']))
+    statement_cache.clear()
+    time_stage(stages, 'cash_flow_statement', lambda: build_cash_flow_statement(data_version, filters, ['Region', 'Year']), cube_rows)
+
+    statement_cache.clear()
+    time_stage(stages, 'kpis', lambda: KPIService(workbook_data['GL_Cube'], filter_index=workbook_data['GL_Cube_filter_index']).by_year, cube_rows)
+    time_stage(stages, 'measures', lambda: build_measures(data_version, [], []), cube_rows)
+    time_stage(stages, 'render', lambda: render_statement_html(format_statement_index(income_statement)), len(income_statement))
+    return stages
+
+
+def compare_results(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    """
+    Lists the stages that took more than tolerance times their time in the baseline results, at the same scale.
+
+    Returns:
+    - list: (lines, stage, baseline seconds, seconds) for each regression.
+    """
+    baseline_scales = {scale['lines']: scale['stages'] for scale in baseline['scales']}
+    regressions = []
+    for scale in results['scales']:
+        for stage, measured in scale['stages'].items():
+            before = baseline_scales.get(scale['lines'], {}).get(stage)
+            if before and measured['seconds'] > before['seconds'] * tolerance:
+                regressions.append((scale['lines'], stage, before['seconds'], measured['seconds']))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic ledgers and benchmark the AccViz statement pipeline')
+    parser.add_argument('command', choices=['generate', 'run'])
+    parser.add_argument('--scales', default=','.join(map(str, BENCHMARK_SCALES)), help='comma-separated numbers of GL lines')
+    parser.add_argument('--accounts', type=int, default=None, help='accounts in the generated COA (at least the template\'s)')
+    parser.add_argument('--territories', type=int, default=None, help='territories in the generated ledger')
+    parser.add_argument('--years', type=int, default=3, help='years the postings are spread over')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--template', default=DATA_FILE_PATH, help='workbook whose sheets and entries are scaled up')
+    parser.add_argument('--data-dir', default='benchmarks/data', help='folder for the generated ledgers, one subfolder per scale')
+    parser.add_argument('--chunk-size', type=int, default=GENERATOR_CHUNK_ROWS, help='rows per GL chunk when generating and loading')
+    parser.add_argument('--output', default=None, help='JSON file for the results; defaults to benchmarks/results/<time>.json')
+    parser.add_argument('--compare', default=None, help='earlier results JSON to report regressions against')
+    args = parser.parse_args()
+
+    scales = [int(scale) for scale in args.scales.split(',') if scale]
+    if args.command == 'generate':
+        for lines in scales:
+            started = time.perf_counter()
+            paths = generate_synthetic_ledger(os.path.join(args.data_dir, str(lines)), lines, args.accounts, args.territories,
+                                              args.years, seed=args.seed, template_path=args.template, chunk_rows=args.chunk_size)
+            print(f"{lines:,} GL lines written to {paths[1]} in {time.perf_counter() - started:.2f}s")
+        sys.exit()
+
+    results = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+                        'pyarrow': pa.__version__, 'machine': platform.machine(), 'cpus': os.cpu_count()},
+        'options': {'accounts': args.accounts, 'territories': args.territories, 'years': args.years, 'seed': args.seed, 'chunk_size': args.chunk_size},
+        'scales': [],
+    }
+    tracemalloc.start()
+    for lines in scales:
+        print(f"{lines:,} GL lines", file=sys.stderr)
+        data_dir = os.path.join(args.data_dir, str(lines))
+        generated = {}
+        time_stage(generated, 'generate', lambda: generate_synthetic_ledger(data_dir, lines, args.accounts, args.territories, args.years,
+                                                                                   seed=args.seed, template_path=args.template, chunk_rows=args.chunk_size))
+        stages = run_benchmark_scale(os.path.join(data_dir, 'Data.xlsx'), os.path.join(data_dir, 'GL.parquet'), args.chunk_size)
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS, and covers the whole run so far
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10)
+        results['scales'].append({'lines': lines, 'generate': generated['generate'], 'stages': stages, 'max_rss_mb': max_rss})
+
+    output = args.output or os.path.join('benchmarks', 'results', time.strftime('%Y%m%d-%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if baseline.get('options') != results['options']:
+            print(f"Note: {args.compare} was run with different options {baseline.get('options')}")
+        regressions = compare_results(results, baseline)
+        for lines, stage, before, after in regressions:
+            print(f"REGRESSION {lines:,} lines {stage}: {before:.3f}s -> {after:.3f}s")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,48 @@
+import pandas as pd
+
+from utils import build_balance_table, update_balance_table, get_balance_lookup
+
+
+COA = pd.DataFrame({'Account_key': [1, 2], 'Account': ['Cash', 'Loans']})
+TERRITORY = pd.DataFrame({'Territory_key': [10, 20], 'Country': ['UK', 'USA']})
+
+
+def make_cube(rows):
+    return pd.DataFrame(rows, columns=['Account_key', 'Territory_key', 'Year', 'Quarter', 'Amount'])
+
+
+CUBE = make_cube([
+    (1, 10, 2018, 'Qtr 1', 100.0),
+    (1, 10, 2018, 'Qtr 3', 50.0),
+    (1, 10, 2020, 'Qtr 2', -30.0),
+    (2, 20, 2019, 'Qtr 4', 200.0),
+])
+
+
+def test_year_end_balances():
+    lookup = get_balance_lookup(build_balance_table(CUBE, COA, TERRITORY))
+    assert lookup[(1, 10, 2018)] == 150.0
+    # a year without postings carries the previous balance forward
+    assert lookup[(1, 10, 2019)] == 150.0
+    assert lookup[(1, 10, 2020)] == 120.0
+    assert lookup[(2, 20, 2020)] == 200.0
+    # no balance before an account's first posting
+    assert (2, 20, 2018) not in lookup.index
+
+
+def test_quarter_end_balances():
+    lookup = get_balance_lookup(build_balance_table(CUBE, COA, TERRITORY, ['Year', 'Quarter']), ['Year', 'Quarter'])
+    assert lookup[(1, 10, 2018, 'Qtr 1')] == 100.0
+    assert lookup[(1, 10, 2018, 'Qtr 3')] == 150.0
+    # carried forward to the quarter ends that have postings on other accounts
+    assert lookup[(1, 10, 2019, 'Qtr 4')] == 150.0
+
+
+def test_lookup_after_rolling_forward():
+    balances = build_balance_table(CUBE, COA, TERRITORY)
+    cube = pd.concat([CUBE, make_cube([(1, 10, 2019, 'Qtr 1', 5.0), (2, 10, 2020, 'Qtr 1', 7.0)])], ignore_index=True)
+    lookup = get_balance_lookup(update_balance_table(balances, cube, COA, TERRITORY, 2019))
+    expected = get_balance_lookup(build_balance_table(cube, COA, TERRITORY))
+    pd.testing.assert_series_equal(lookup.sort_index(), expected.sort_index(), check_dtype=False)
+    assert lookup[(1, 10, 2020)] == 125.0
+    assert lookup[(2, 10, 2020)] == 7.0
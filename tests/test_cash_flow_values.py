@@ -0,0 +1,97 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils import transform_cash_flow_values
+
+
+VALUE_TYPES = ['All_FTP', 'All_FTP_CS', 'All_FTP_Positive', 'All_FTP_Negative', 'All_FTP_Positive_CS',
+               'All_FTP_Negative_CS', 'Closing_balance', 'Opening_balance', 'Not_a_rule']
+SIGNS = ['Positive', 'Negative']
+
+
+def transform_cash_flow_values_loop(cash_flow_df, years):
+    """
+    The row-by-row loop the cash flow tab used before `transform_cash_flow_values`, kept as the reference.
+    """
+    transformed_cf_df = pd.DataFrame()
+    for _, row in cash_flow_df.iterrows():
+        # pandas infers a string row when every year is missing, which could not take the numbers below
+        row = row.astype(object)
+        prv_year_value = 0
+        for yr in years:
+            current_year_value = 0
+
+            if row['ValueType'] == 'All_FTP':
+                current_year_value += row[yr]
+            elif row['ValueType'] == 'All_FTP_CS':
+                current_year_value -= row[yr]
+            elif row['ValueType'] == 'All_FTP_Negative' and row['Sign'] == 'Negative':
+                current_year_value += row[yr]
+            elif row['ValueType'] == 'All_FTP_Positive_CS' and row['Sign'] == 'Positive':
+                current_year_value -= row[yr]
+            elif row['ValueType'] == 'All_FTP_Negative_CS' and row['Sign'] == 'Negative':
+                current_year_value -= row[yr]
+            elif row['ValueType'] == 'All_FTP_Positive' and row['Sign'] == 'Positive':
+                current_year_value += row[yr]
+            elif row['ValueType'] == 'Closing_balance':
+                current_year_value += row[yr] + prv_year_value
+                prv_year_value = current_year_value
+            elif row['ValueType'] == 'Opening_balance':
+                current_year_value = prv_year_value
+                prv_year_value = row[yr] + prv_year_value
+
+            row[yr] = current_year_value
+        transformed_cf_df = pd.concat([transformed_cf_df, row], axis=1)
+
+    return transformed_cf_df.transpose()
+
+
+def make_cash_flow_df(years, nan_share, seed):
+    rng = np.random.default_rng(seed)
+    combinations = list(itertools.product(VALUE_TYPES, SIGNS)) * 3
+    values = rng.integers(-1000, 1000, size=(len(combinations), len(years))).astype('float64')
+    values[rng.random(values.shape) < nan_share] = np.nan
+    cash_flow_df = pd.DataFrame(values, columns=years)
+    cash_flow_df.insert(0, 'ValueType', [value_type for value_type, _ in combinations])
+    cash_flow_df.insert(1, 'Sign', [sign for _, sign in combinations])
+    cash_flow_df.insert(2, 'Account', [f'Account {i}' for i in range(len(combinations))])
+    return cash_flow_df
+
+
+def assert_matches_loop(cash_flow_df, years):
+    expected = transform_cash_flow_values_loop(cash_flow_df, years)
+    expected = expected.astype({year: 'float64' for year in years}).reset_index(drop=True)
+    result = transform_cash_flow_values(cash_flow_df, years)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+@pytest.mark.parametrize('nan_share', [0.0, 0.2, 0.6])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_matches_loop(nan_share, seed):
+    years = [2018, 2019, 2020, 2021]
+    assert_matches_loop(make_cash_flow_df(years, nan_share, seed), years)
+
+
+@pytest.mark.parametrize('years', [[2020, 2018, 2019], [2021, 2020, 2019, 2018]])
+def test_matches_loop_with_unsorted_years(years):
+    # both walk the years in the order given, so the builder must pass them in chronological order
+    assert_matches_loop(make_cash_flow_df(years, 0.2, 3), years)
+
+
+def test_year_order_sets_the_running_balances():
+    cash_flow_df = pd.DataFrame({'ValueType': ['Closing_balance', 'Opening_balance'], 'Sign': ['Positive', 'Positive'],
+                                 2019: [20.0, 20.0], 2018: [10.0, 10.0]})
+    result = transform_cash_flow_values(cash_flow_df, [2018, 2019])
+    assert result[2018].tolist() == [10.0, 0.0]
+    assert result[2019].tolist() == [30.0, 10.0]
+
+
+def test_leaves_input_unchanged():
+    years = [2018, 2019]
+    cash_flow_df = make_cash_flow_df(years, 0.2, 4)
+    original = cash_flow_df.copy()
+    transform_cash_flow_values(cash_flow_df, years)
+    pd.testing.assert_frame_equal(cash_flow_df, original)
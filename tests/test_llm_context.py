@@ -0,0 +1,19 @@
+import re
+
+import pytest
+
+from utils import build_llm_context, get_data_version
+
+
+@pytest.mark.parametrize('statement', ['Income Statement', 'Key Ratios'])
+@pytest.mark.parametrize('time_grain', ['Year', 'Quarter'])
+def test_year_filter_keeps_the_change_on_a_year_earlier(statement, time_grain):
+    context = build_llm_context(get_data_version(), statement, ([2020], [], []), time_grain)
+    assert re.search(r'YoY [^-]', context)
+    # the year before is only built for the change, not shown
+    assert '2019' not in context
+
+
+def test_filters_without_rows():
+    context = build_llm_context(get_data_version(), 'Income Statement', ([], ['Europe'], ['USA']))
+    assert context == '#### Income Statement\n- no data for the selected filters'
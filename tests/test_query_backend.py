@@ -0,0 +1,8 @@
+import pytest
+
+from utils import check_query_backend
+
+
+def test_duckdb_matches_pandas():
+    pytest.importorskip('duckdb')
+    assert check_query_backend() == []
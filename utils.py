@@ -1,4 +1,25 @@
 import os 
+import sys
+import json
+import time
+import hashlib
+import argparse
+import re
+import threading
+import weakref
+import tempfile
+import functools
+import sqlite3
+import queue
+import uuid
+import logging
+import logging.handlers
+import contextlib
+from collections import OrderedDict, deque
+import openpyxl
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import streamlit as st
 import pandas as pd
 import numpy as np
@@ -16,99 +37,2105 @@ percent_formatter = lambda num: '{0:,.2f}%'.format(num * 100) if num >= 0 else '
 percent_formatter_v2 = lambda num: '{0:,.2f}%'.format(num ) if num >= 0 else '({0:,.2f}%)'.format(abs(num))
 
 
-@st.cache_data
-def load_gl_transactions_data_from_excel():
-    # read the data from the excel file
-    file_path = 'data/Data.xlsx'
-    gl = pd.read_excel(file_path, sheet_name='GL')
-    coa = pd.read_excel(file_path, sheet_name='COA')
-    trt = pd.read_excel(file_path, sheet_name='Territory')
-    cln = pd.read_excel(file_path, sheet_name='Calendar')
+DATA_FILE_PATH = 'data/Data.xlsx'
+
+# every sheet the app needs, read from the workbook in a single pass
+WORKBOOK_SHEETS = ['GL', 'COA', 'Territory', 'Calendar', 'PnL Structure', 'BS Structure', 'CF Structure']
+
+# tables kept in the on-disk cache; the raw GL sheet is only needed to build GL_Master
+CACHED_TABLES = ['GL_Master', 'GL_Cube', 'GL_Balances', 'COA', 'Territory', 'Calendar', 'PnL Structure', 'BS Structure', 'CF Structure']
+
+# large tables every session reads from one shared memory-mapped Arrow file rather than its own copy
+MAPPED_TABLES = ['GL_Master', 'GL_Cube', 'GL_Balances']
+# rows per record batch of the memory-mapped files: bounds the memory used to write them, and tables that fit in one batch are read back without copies
+MAPPED_BATCH_ROWS = 1_000_000
+
+# statements longer than this are shown in collapsible groups, one page of this many rows at a time
+DASHBOARD_PAGE_ROWS = int(os.getenv('ACCVIZ_DASHBOARD_PAGE_ROWS') or 100)
+
+# rows shown on one page of the Transaction Details tab
+TRANSACTION_PAGE_ROWS = int(os.getenv('ACCVIZ_TRANSACTION_PAGE_ROWS') or 100)
+
+# bounds of the statement cache shared by every session
+STATEMENT_CACHE_MAX_ENTRIES = int(os.getenv('ACCVIZ_STATEMENT_CACHE_ENTRIES') or 256)
+STATEMENT_CACHE_MAX_BYTES = int(float(os.getenv('ACCVIZ_STATEMENT_CACHE_MB') or 256) * 2**20)
+
+# Calendar columns that identify a period at each time grain of the statements
+TIME_GRAINS = {
+    'Year': ['Year'],
+    'Quarter': ['Year', 'Quarter'],
+    'Month': ['Year', 'Month'],
+}
+
+# LLM backend for the sidebar questions ('gemini' or the offline 'local' stand-in), and its on-disk response cache
+LLM_BACKEND = os.getenv('ACCVIZ_LLM_BACKEND') or 'gemini'
+LLM_MODEL = os.getenv('ACCVIZ_LLM_MODEL') or 'gemini-1.5-flash'
+LLM_TIMEOUT = float(os.getenv('ACCVIZ_LLM_TIMEOUT') or 60)
+LLM_CACHE_PATH = os.getenv('ACCVIZ_LLM_CACHE') or 'data/.cache/llm_responses.sqlite'
+LLM_CACHE_TTL = float(os.getenv('ACCVIZ_LLM_CACHE_TTL_HOURS') or 24 * 7) * 3600
+LLM_CACHE_MAX_ENTRIES = int(os.getenv('ACCVIZ_LLM_CACHE_ENTRIES') or 1000)
+LLM_CACHE_MAX_BYTES = int(float(os.getenv('ACCVIZ_LLM_CACHE_MB') or 64) * 2**20)
+# approximate token budget for the statement summaries sent with a question, shared by the ticked statements
+LLM_CONTEXT_TOKENS = int(os.getenv('ACCVIZ_LLM_CONTEXT_TOKENS') or 1500)
+# seconds the local backend waits per streamed word, to simulate model latency in load tests
+LLM_LOCAL_DELAY = float(os.getenv('ACCVIZ_LLM_LOCAL_DELAY') or 0)
+# the latency percentiles are taken over this many most recent requests
+LLM_LATENCY_SAMPLES = 1000
+
+# JSON-lines log of the pipeline stage timings that the app writes (set it empty to turn the log off), and the number of recent stages kept in memory
+STAGE_LOG_PATH = os.getenv('ACCVIZ_STAGE_LOG', 'logs/pipeline_stages.jsonl')
+STAGE_HISTORY = int(os.getenv('ACCVIZ_STAGE_HISTORY') or 2000)
+# always show the pipeline timings panel in the sidebar; otherwise it is shown with ?debug=1 in the URL
+DEBUG_PANEL = (os.getenv('ACCVIZ_DEBUG_PANEL') or '').lower() in ('1', 'true', 'yes')
+
+# engine that filters, joins and aggregates the GL tables for the statements: 'pandas', or 'duckdb' to push that work into SQL
+QUERY_BACKEND = (os.getenv('ACCVIZ_QUERY_BACKEND') or 'pandas').lower()
+QUERY_BACKENDS = ('pandas', 'duckdb')
+
+# grain of the pre-aggregated GL cube; Sign keeps positive and negative postings apart for the cash flow rules
+CUBE_KEYS = ['Account_key', 'Territory_key', 'Year', 'Quarter', 'Month', 'Sign']
+
+# optional CSV or Parquet GL export to read instead of the workbook's GL sheet, and the rows per chunk when streaming it
+GL_SOURCE_PATH = os.getenv('ACCVIZ_GL_SOURCE') or None
+GL_CHUNK_SIZE = int(os.getenv('ACCVIZ_GL_CHUNK_SIZE') or 0)
+
+# folder where monthly GL batch files are dropped to be appended to the cache, and the period grain they replace
+GL_BATCH_DIR = os.getenv('ACCVIZ_GL_BATCH_DIR') or 'data/batches'
+GL_BATCH_EXTENSIONS = ('.csv', '.parquet', '.xlsx')
+PERIOD_COLUMNS = ['Year', 'Month']
+
+# partial cubes from streamed GL chunks are folded together once this many have accumulated
+CUBE_FOLD_EVERY = 8
+
+# bump when the layout of the cached tables changes so caches written by older code are rebuilt
+CACHE_SCHEMA_VERSION = 4
+
+# dimension columns stored as categoricals, with categories taken from the sheet that owns them
+DIMENSION_COLUMNS = {
+    'COA': ['Report', 'Class', 'SubClass', 'SubClass2', 'Account', 'SubAccount'],
+    'Territory': ['Region', 'Country'],
+    'Calendar': ['Quarter', 'Month', 'Day'],
+}
+
+
+def get_output_size(output):
+    """
+    Returns the rows and shallow memory in MB of a stage's output: a DataFrame, a Series, or a tuple starting with one.
+    """
+    if isinstance(output, (tuple, list)) and output:
+        output = output[0]
+    if isinstance(output, pd.DataFrame):
+        return len(output), float(output.memory_usage(index=True).sum()) / 2**20
+    if isinstance(output, pd.Series):
+        return len(output), float(output.memory_usage(index=True)) / 2**20
+    return None, None
+
+
+class StageRecorder:
+    """
+    Records the wall time, rows in and out and DataFrame memory of the pipeline stages.
+
+    A stage started inside another one is recorded one level deeper, and the stages of a script
+    run share the run id set by `start_run` on that thread, so the debug panel can show where a
+    rerun spent its time. The most recent records are kept in memory and every record is also
+    appended to a rotating JSON-lines log when log_path is set; the log is opened on the first
+    record, not on import. Memory is measured without inspecting object columns, so recording a
+    stage costs microseconds.
+    """
+
+    def __init__(self, log_path=None, max_records=STAGE_HISTORY):
+        self.records = deque(maxlen=max_records)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.log_path = log_path
+        self._logger = None
+
+    def get_logger(self):
+        """
+        Returns the logger writing to log_path, creating the folder and handler on first use, or None when logging is off.
+        """
+        if self._logger is None and self.log_path:
+            with self._lock:
+                if self._logger is None and self.log_path:
+                    if os.path.dirname(self.log_path):
+                        os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+                    logger = logging.getLogger('accviz.stages')
+                    if not logger.handlers:
+                        handler = logging.handlers.RotatingFileHandler(self.log_path, maxBytes=10 * 2**20, backupCount=3)
+                        handler.setFormatter(logging.Formatter('%(message)s'))
+                        logger.addHandler(handler)
+                        logger.setLevel(logging.INFO)
+                        logger.propagate = False
+                    self._logger = logger
+        return self._logger
+
+    def enable_log(self, log_path=STAGE_LOG_PATH):
+        """
+        Appends every record from now on to the rotating log at log_path; an empty path leaves the log off.
+        """
+        with self._lock:
+            if (log_path or None) != self.log_path:
+                self.log_path = log_path or None
+                self._logger = None
+
+    def disable_log(self):
+        """
+        Stops appending records to the log file, e.g. in worker processes, whose rotations would race the parent's.
+        """
+        with self._lock:
+            self.log_path = None
+            self._logger = None
+
+    def start_run(self, label=''):
+        """
+        Starts a new run on this thread; the stages recorded on it until the next call share its id.
+        """
+        self._local.run = uuid.uuid4().hex[:12]
+        self._local.label = label
+        self._local.depth = 0
+        return self._local.run
+
+    @contextlib.contextmanager
+    def stage(self, name, rows_in=None):
+        """
+        Records the block as a stage; put its result in the yielded record's 'output' to record its size.
+        """
+        depth = getattr(self._local, 'depth', 0)
+        record = {'run': getattr(self._local, 'run', None), 'label': getattr(self._local, 'label', ''), 'stage': name,
+                  'depth': depth, 'started_at': time.time(), 'rows_in': rows_in}
+        self._local.depth = depth + 1
+        started = time.perf_counter()
+        try:
+            yield record
+        except Exception as error:
+            record['error'] = repr(error)
+            raise
+        finally:
+            record['seconds'] = time.perf_counter() - started
+            self._local.depth = depth
+            record['rows_out'], record['memory_mb'] = get_output_size(record.pop('output', None))
+            with self._lock:
+                self.records.append(record)
+            logger = self.get_logger()
+            if logger is not None:
+                logger.info(json.dumps(record, default=str))
+
+    def track(self, name=None):
+        """
+        Decorator recording every call of a function as a stage, with the rows of its first DataFrame argument and of its result.
+        """
+        def decorator(function):
+            stage_name = name or function.__name__
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                rows_in = next((len(arg) for arg in args if isinstance(arg, pd.DataFrame)), None)
+                with self.stage(stage_name, rows_in) as record:
+                    record['output'] = function(*args, **kwargs)
+                    return record['output']
+            return wrapper
+        return decorator
+
+    def get_run(self, run=None):
+        """
+        Returns the records of a run, by default the current run on this thread, in the order they finished.
+        """
+        run = run or getattr(self._local, 'run', None)
+        with self._lock:
+            return [record for record in self.records if record['run'] == run]
+
+    def summarize(self):
+        """
+        Returns the calls and total, mean and max seconds of each stage over the recent records, slowest first.
+        """
+        with self._lock:
+            records = pd.DataFrame(list(self.records), columns=['stage', 'seconds'])
+        summary = records.groupby('stage')['seconds'].agg(calls='count', total_s='sum', mean_ms='mean', max_ms='max')
+        summary[['mean_ms', 'max_ms']] *= 1000
+        return summary.sort_values('total_s', ascending=False)
+
+
+# one recorder per process, shared by every session; only the app turns its log file on, so scripts and tests leave no files behind
+pipeline_stages = StageRecorder()
+track_stage = pipeline_stages.track
+measure_stage = pipeline_stages.stage
+
+
+def get_cache_paths(file_path=DATA_FILE_PATH):
+    """
+    Returns the locations of the on-disk columnar cache for a workbook.
+
+    The cache lives in a hidden `.cache` folder next to the workbook and holds one Parquet
+    file per table and a JSON manifest describing the workbook it was built from.
+    """
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(file_path)), '.cache')
+    file_stem = os.path.splitext(os.path.basename(file_path))[0]
+    paths = {
+        'dir': cache_dir,
+        'manifest': os.path.join(cache_dir, file_stem + '.manifest.json'),
+    }
+    for table in CACHED_TABLES:
+        paths[table] = os.path.join(cache_dir, file_stem + '_' + table.replace(' ', '_') + '.parquet')
+    return paths
+
+
+def get_file_fingerprint(file_path, with_hash=True):
+    """
+    Returns the path, size, modification time and (optionally) the SHA-256 hash of a file.
+    """
+    stat = os.stat(file_path)
+    fingerprint = {'path': os.path.abspath(file_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if with_hash:
+        sha256 = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(block)
+        fingerprint['sha256'] = sha256.hexdigest()
+    return fingerprint
+
+
+def read_cache_manifest(file_path=DATA_FILE_PATH):
+    manifest_path = get_cache_paths(file_path)['manifest']
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def is_fingerprint_current(cached, file_path):
+    """
+    Compares a file with the fingerprint stored when the cache was built.
+
+    Size and modification time are compared first; the content hash is only computed when
+    they differ, so a file that was touched but not edited still matches.
+
+    Returns:
+    - tuple: (matches, refreshed fingerprint to store when only the metadata changed, otherwise None).
+    """
+    current = get_file_fingerprint(file_path, with_hash=False)
+    if cached['path'] == current['path'] and cached['size'] == current['size'] and cached['mtime_ns'] == current['mtime_ns']:
+        return True, None
+
+    current = get_file_fingerprint(file_path)
+    if cached['sha256'] != current['sha256']:
+        return False, None
+    return True, current
+
+
+def is_cache_valid(file_path=DATA_FILE_PATH, gl_source=None, batch_dir=None):
+    """
+    Checks whether the on-disk cache was built from the current version of the workbook (and GL export, if any).
+
+    Batch files that are new or edited are appended by `append_new_gl_batches` and do not
+    invalidate the cache, but a batch that was removed from the batch folder does.
+    """
+    paths = get_cache_paths(file_path)
+    manifest = read_cache_manifest(file_path)
+    if manifest is None or manifest.get('schema_version') != CACHE_SCHEMA_VERSION or manifest.get('tables') != CACHED_TABLES:
+        return False
+    if not all(os.path.exists(paths[table]) for table in CACHED_TABLES):
+        return False
+    if not all(os.path.exists(part['path']) for part in manifest['gl_parts']):
+        return False
+    if not set(manifest['batches']).issubset(map(os.path.abspath, list_gl_batches(batch_dir))):
+        return False
+
+    sources = get_source_paths(file_path, gl_source)
+    if set(manifest['sources']) != set(sources):
+        return False
+
+    refreshed = False
+    for source, source_path in sources.items():
+        if manifest['sources'][source]['path'] != os.path.abspath(source_path):
+            return False
+        matches, fingerprint = is_fingerprint_current(manifest['sources'][source], source_path)
+        if not matches:
+            return False
+        if fingerprint is not None:
+            manifest['sources'][source] = fingerprint
+            refreshed = True
+
+    # same content, only the metadata changed: refresh the manifest so the hash is skipped next time
+    if refreshed:
+        write_cache_manifest(file_path, manifest)
+    return True
+
+
+def write_cache_manifest(file_path, manifest):
+    manifest_path = get_cache_paths(file_path)['manifest']
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def get_source_paths(file_path=DATA_FILE_PATH, gl_source=None):
+    sources = {'workbook': file_path}
+    if gl_source:
+        sources['gl_source'] = gl_source
+    return sources
+
+
+def list_gl_batches(batch_dir=GL_BATCH_DIR):
+    """
+    Returns the GL batch files in batch_dir in name order, which is the order they are appended in.
+    """
+    if not batch_dir or not os.path.isdir(batch_dir):
+        return []
+    return sorted(os.path.join(batch_dir, name) for name in os.listdir(batch_dir) if name.lower().endswith(GL_BATCH_EXTENSIONS))
+
+
+def is_in_periods(df, periods):
+    """
+    Returns a boolean mask of the rows of df whose PERIOD_COLUMNS fall in periods, a set of (Year, Month) tuples.
+    """
+    return pd.MultiIndex.from_frame(df[PERIOD_COLUMNS]).isin(list(periods))
+
+
+def get_periods(df):
+    return sorted((int(year), str(month)) for year, month in df[PERIOD_COLUMNS].drop_duplicates().itertuples(index=False))
+
+
+@track_stage()
+def read_workbook_sheets(file_path=DATA_FILE_PATH, sheet_names=WORKBOOK_SHEETS):
+    """
+    Reads all the required sheets from the workbook in a single pass.
+
+    Passing a list of sheet names makes pandas open the workbook once (openpyxl in
+    read-only mode) and parse each sheet from the same handle.
+    """
+    return pd.read_excel(file_path, sheet_name=sheet_names)
+
+
+def iter_gl_chunks(source=DATA_FILE_PATH, chunk_size=100000):
+    """
+    Yields the GL rows of a workbook, CSV or Parquet file in DataFrames of at most chunk_size rows.
+
+    Workbooks are read row by row from the 'GL' sheet with openpyxl in read-only mode, CSV files
+    with pandas' chunked reader and Parquet files batch by batch, so only one chunk is held in
+    memory at a time. Without a chunk_size the whole GL is yielded as a single chunk.
+    """
+    extension = os.path.splitext(source)[1].lower()
+    if not chunk_size:
+        if extension == '.csv':
+            yield pd.read_csv(source, parse_dates=['Date'])
+        elif extension == '.parquet':
+            yield pd.read_parquet(source)
+        else:
+            yield pd.read_excel(source, sheet_name='GL')
+    elif extension == '.csv':
+        yield from pd.read_csv(source, chunksize=chunk_size, parse_dates=['Date'])
+    elif extension == '.parquet':
+        for batch in pq.ParquetFile(source).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        workbook = openpyxl.load_workbook(source, read_only=True, data_only=True)
+        try:
+            rows = workbook['GL'].iter_rows(values_only=True)
+            header = next(rows)
+            chunk = []
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) == chunk_size:
+                    yield pd.DataFrame(chunk, columns=header).dropna(how='all')
+                    chunk = []
+            if chunk:
+                yield pd.DataFrame(chunk, columns=header).dropna(how='all')
+        finally:
+            workbook.close()
+
+
+def apply_compact_schema(sheets, sheet_names=list(DIMENSION_COLUMNS)):
+    """
+    Converts the dimension sheets to a compact schema before they are joined to the GL.
+
+    Each column in DIMENSION_COLUMNS becomes a Categorical whose categories are the sorted values
+    of its dimension sheet, so GL_Master and the dimension tables share the same categories and
+    pivots order the labels exactly as they did for plain strings. Year becomes a small integer.
+
+    Returns:
+    - dict: A copy of sheets with the converted tables.
+    """
+    sheets = dict(sheets)
+    for sheet_name in sheet_names:
+        df = sheets[sheet_name].copy()
+        for column in DIMENSION_COLUMNS[sheet_name]:
+            df[column] = df[column].astype(pd.CategoricalDtype(sorted(df[column].dropna().unique())))
+        sheets[sheet_name] = df
+
+    if 'Calendar' in sheet_names:
+        sheets['Calendar']['Year'] = sheets['Calendar']['Year'].astype('int16')
+    return sheets
+
+
+def extend_calendar(calendar, dates):
+    """
+    Adds the dates missing from the Calendar table, with their Year, Quarter, Month and Day derived from the date.
+
+    GL batches can post to days the Calendar sheet does not cover yet; deriving those days in the
+    sheet's own format ('Qtr 1', 'Jan', 'Mon') lets them be appended without editing the workbook,
+    which would invalidate the whole cache.
+
+    Parameters:
+    - calendar (pd.DataFrame): The Calendar table after `apply_compact_schema`.
+    - dates (pd.Series): The dates posted to.
+
+    Returns:
+    - pd.DataFrame: calendar unchanged when it covers every date, else a copy with the missing dates added in date order.
+    """
+    dates = pd.Series(pd.to_datetime(dates.dropna().unique()).astype(calendar['Date'].dtype))
+    missing = dates[~dates.isin(calendar['Date'])].sort_values(ignore_index=True)
+    if missing.empty:
+        return calendar
+    added = pd.DataFrame({
+        'Date': missing,
+        'Year': missing.dt.year.astype('int16'),
+        'Quarter': 'Qtr ' + missing.dt.quarter.astype('str'),
+        'Month': missing.dt.strftime('%b'),
+        'Day': missing.dt.strftime('%a'),
+    })
+    calendar = pd.concat([calendar.astype({column: 'object' for column in DIMENSION_COLUMNS['Calendar']}), added], ignore_index=True)
+    calendar = calendar.sort_values('Date', ignore_index=True)
+    return apply_compact_schema({'Calendar': calendar}, ['Calendar'])['Calendar']
+
+
+@track_stage()
+def build_gl_master(sheets):
+    gl = sheets['GL'].copy()
+    coa = sheets['COA']
+    trt = sheets['Territory']
+    cln = sheets['Calendar']
+
+    # the GL can come from a workbook, CSV or Parquet export, so align its key and amount types with the dimensions
+    gl['Amount'] = gl['Amount'].astype('float64')
+    gl['Date'] = pd.to_datetime(gl['Date']).astype(cln['Date'].dtype)
 
     # join the data from all the sheets based on relevant keys
     cleaned_data = pd.merge(gl, coa, left_on='Account_key', right_on='Account_key', how='inner', suffixes=('', ''))
     cleaned_data = pd.merge(cleaned_data, trt, left_on='Territory_key', right_on='Territory_key', how='left')
     cleaned_data = pd.merge(cleaned_data, cln, left_on='Date', right_on='Date', how='left')
-     
-    cleaned_data['Year'] = cleaned_data['Year'].astype('str')
 
-    return cleaned_data
+    return cleaned_data
+
+
+def aggregate_gl_cube(gl_master):
+    """
+    Sums GL rows (or partial cubes) to one row per CUBE_KEYS combination, without the dimension labels.
+    """
+    if 'Sign' not in gl_master.columns:
+        sign = pd.Categorical(np.where(gl_master['Amount'] > 0, 'Positive', 'Negative'), categories=['Negative', 'Positive'])
+        gl_master = gl_master[CUBE_KEYS[:-1] + ['Amount']].assign(Sign=sign)
+    return gl_master.groupby(CUBE_KEYS, observed=True, dropna=False)['Amount'].sum().reset_index()
+
+
+@track_stage()
+def build_gl_cube(gl_master, coa, territory):
+    """
+    Pre-aggregates the GL to one row per account, territory, period and sign, with the COA and Territory labels joined back on.
+
+    The statements only need amounts at this grain, so they are built from the cube instead of
+    the transaction-level GL_Master.
+    
+    Parameters:
+    - gl_master (pd.DataFrame): The joined GL data, or partial cubes to fold together.
+    - coa (pd.DataFrame): The chart of accounts.
+    - territory (pd.DataFrame): The territory dimension.
+
+    Returns:
+    - pd.DataFrame: The cube, with CUBE_KEYS, the summed 'Amount' and the dimension labels.
+    """
+    cube = aggregate_gl_cube(gl_master)
+
+    cube = pd.merge(cube, coa, left_on='Account_key', right_on='Account_key', how='inner', suffixes=('', ''))
+    cube = pd.merge(cube, territory, left_on='Territory_key', right_on='Territory_key', how='left')
+    return cube
+
+
+@track_stage()
+def build_balance_table(cube, coa, territory, period_columns=['Year'], all_periods=None):
+    """
+    Computes the closing balance of every account and territory at each period end.
+
+    Movements are laid out on a dense account/territory x period grid so a period without
+    postings carries the previous balance forward. An account/territory only gets rows from its
+    first period with postings, so "no balance yet" stays distinct from a zero balance.
+    
+    Parameters:
+    - cube (pd.DataFrame): The GL cube (or any GL data with 'Account_key', 'Territory_key' and 'Amount').
+    - coa (pd.DataFrame): The chart of accounts.
+    - territory (pd.DataFrame): The territory dimension.
+    - period_columns (list): ['Year'] for year-end balances, ['Year', 'Quarter'] for quarter-end balances,
+      or ['Period_SortKey'] for any grain from `get_calendar_periods`.
+    - all_periods (list): Optional sorted values of the period column to lay out, so periods without any postings also get balances.
+
+    Returns:
+    - pd.DataFrame: One row per account, territory and period end with 'Balance' and the dimension labels.
+    """
+    movements = cube.groupby(['Account_key', 'Territory_key'] + period_columns, observed=True)['Amount'].sum()
+    movements = movements.unstack(period_columns).sort_index(axis=1)
+    if all_periods is not None:
+        movements = movements.reindex(columns=all_periods)
+
+    has_history = movements.notna().cumsum(axis=1) > 0
+    balances = movements.fillna(0).cumsum(axis=1).where(has_history)
+    balances = balances.stack(list(range(len(period_columns)))).rename('Balance').reset_index().dropna(subset=['Balance'])
+
+    balances = pd.merge(balances, coa, left_on='Account_key', right_on='Account_key', how='inner', suffixes=('', ''))
+    balances = pd.merge(balances, territory, left_on='Territory_key', right_on='Territory_key', how='left')
+    return balances
+
+
+def update_balance_table(balance_table, cube, coa, territory, from_year):
+    """
+    Rolls the year-end balances forward from the last closing balance before from_year.
+
+    Years before from_year are kept as they are; later years are recomputed from that opening
+    balance and the cube's movements, so an append only costs the years it touches.
+    
+    Parameters:
+    - balance_table (pd.DataFrame): The current output of `build_balance_table`.
+    - cube (pd.DataFrame): The GL cube, already updated with the new movements.
+    - coa (pd.DataFrame): The chart of accounts.
+    - territory (pd.DataFrame): The territory dimension.
+    - from_year (int): The earliest year whose movements changed.
+
+    Returns:
+    - pd.DataFrame: The balance table, in the same layout and order as `build_balance_table` produces.
+    """
+    kept = balance_table[balance_table['Year'] < from_year]
+    opening = kept.sort_values('Year').groupby(['Account_key', 'Territory_key'])['Balance'].last()
+
+    movements = cube[cube['Year'] >= from_year].groupby(['Account_key', 'Territory_key', 'Year'], observed=True)['Amount'].sum()
+    movements = movements.unstack('Year').sort_index(axis=1)
+    keys = opening.index.union(movements.index)
+    movements = movements.reindex(keys)
+    opening = opening.reindex(keys)
+
+    has_history = (movements.notna().cumsum(axis=1).to_numpy() > 0) | opening.notna().to_numpy()[:, None]
+    balances = movements.fillna(0).cumsum(axis=1).add(opening.fillna(0), axis=0).where(has_history)
+    balances = balances.stack().rename('Balance').reset_index().dropna(subset=['Balance'])
+
+    balances = pd.merge(balances, coa, left_on='Account_key', right_on='Account_key', how='inner', suffixes=('', ''))
+    balances = pd.merge(balances, territory, left_on='Territory_key', right_on='Territory_key', how='left')
+
+    balances = pd.concat([kept, balances.astype(kept.dtypes.to_dict())], ignore_index=True)
+    return balances.sort_values(['Account_key', 'Territory_key', 'Year'], ignore_index=True)
+
+
+def get_calendar_periods(calendar, time_grain='Year'):
+    """
+    Lists the periods of a time grain in date order, from the Calendar sheet.
+
+    Returns:
+    - pd.DataFrame: The grain's TIME_GRAINS columns, an integer 'Period_SortKey' counting the periods
+      in date order and a 'Period' label ('2020', '2020 Qtr 1', '2020 Jan') as an ordered categorical.
+    """
+    columns = TIME_GRAINS[time_grain]
+    periods = calendar.groupby(columns, observed=True)['Date'].min().sort_values().reset_index().drop(columns='Date')
+    periods['Period_SortKey'] = np.arange(len(periods))
+    labels = periods[columns].astype('str').agg(' '.join, axis=1)
+    periods['Period'] = pd.Categorical(labels, categories=labels, ordered=True)
+    return periods
+
+
+def get_period_comparison(comparison_by, time_grain='Year'):
+    """
+    Replaces 'Year' in the comparison columns with the 'Period' label of a finer time grain.
+    """
+    if time_grain == 'Year':
+        return comparison_by
+    return ['Period' if column == 'Year' else column for column in comparison_by]
+
+
+def get_balance_lookup(balance_table, period_columns=['Year']):
+    """
+    Returns the closing balances as a Series indexed by (Account_key, Territory_key, *period_columns), for hashed O(1) lookups.
+
+    Works on the output of `build_balance_table` or `update_balance_table`; a key that is missing
+    has no balance yet at that period end.
+    """
+    return balance_table.set_index(['Account_key', 'Territory_key'] + period_columns)['Balance']
+
+
+def normalize_object_columns(df):
+    # Excel columns can mix text and numbers, which Parquet cannot store in one column
+    for column in df.columns[df.dtypes == object]:
+        df[column] = df[column].where(df[column].isna(), df[column].astype('str'))
+    return df
+
+
+def write_cache_table(df, path):
+    normalize_object_columns(df).to_parquet(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+
+
+@track_stage()
+def rebuild_data_cache(file_path=DATA_FILE_PATH, gl_source=None, chunk_size=None):
+    """
+    Re-reads the workbook and rewrites the on-disk Parquet cache, regardless of its current state.
+
+    With a chunk_size the GL is streamed: each chunk is joined to the dimension sheets as it
+    arrives, appended to the GL_Master Parquet file and folded into the cube, so peak memory is
+    bounded by the chunk size rather than by the size of the ledger.
+    
+    Parameters:
+    - file_path (str): The workbook with the dimension and structure sheets (and the GL, unless gl_source is given).
+    - gl_source (str): Optional CSV or Parquet GL export to read instead of the workbook's GL sheet.
+    - chunk_size (int): Rows per GL chunk; None or 0 reads the GL in one go.
+
+    Returns:
+    - dict: The number of rows written for each table in CACHED_TABLES.
+    """
+    paths = get_cache_paths(file_path)
+    os.makedirs(paths['dir'], exist_ok=True)
+
+    # fingerprint before reading so an edit made while we parse invalidates the cache on the next load
+    fingerprints = {source: get_file_fingerprint(source_path) for source, source_path in get_source_paths(file_path, gl_source).items()}
+
+    if gl_source is None and not chunk_size:
+        sheets = read_workbook_sheets(file_path)
+        gl_chunks = [sheets.pop('GL')]
+    else:
+        sheets = read_workbook_sheets(file_path, [sheet for sheet in WORKBOOK_SHEETS if sheet != 'GL'])
+        gl_chunks = iter_gl_chunks(gl_source or file_path, chunk_size)
+    sheets = apply_compact_schema(sheets)
+
+    gl_master_rows = 0
+    partial_cubes = []
+    writer = None
+    try:
+        for gl_chunk in gl_chunks:
+            gl_master = normalize_object_columns(build_gl_master({**sheets, 'GL': gl_chunk}))
+            table = pa.Table.from_pandas(gl_master, schema=writer.schema if writer else None, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(paths['GL_Master'] + '.tmp', table.schema)
+            writer.write_table(table)
+            gl_master_rows += len(gl_master)
+
+            partial_cubes.append(aggregate_gl_cube(gl_master))
+            if len(partial_cubes) >= CUBE_FOLD_EVERY:
+                partial_cubes = [aggregate_gl_cube(pd.concat(partial_cubes, ignore_index=True))]
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        raise ValueError(f"No GL rows found in {gl_source or file_path}")
+
+    tables = {table: sheets[table] for table in CACHED_TABLES if table in sheets}
+    tables['GL_Cube'] = build_gl_cube(pd.concat(partial_cubes, ignore_index=True), sheets['COA'], sheets['Territory'])
+    tables['GL_Balances'] = build_balance_table(tables['GL_Cube'], sheets['COA'], sheets['Territory'])
+
+    for table, df in tables.items():
+        write_cache_table(df, paths[table])
+    os.replace(paths['GL_Master'] + '.tmp', paths['GL_Master'])
+
+    row_counts = {table: len(df) for table, df in tables.items()}
+    row_counts['GL_Master'] = gl_master_rows
+    write_cache_manifest(file_path, {
+        'sources': fingerprints,
+        'schema_version': CACHE_SCHEMA_VERSION,
+        'tables': CACHED_TABLES,
+        'row_counts': row_counts,
+        # GL_Master is stored in parts: the rows read from the sources, then one part per appended batch
+        'gl_parts': [{'path': paths['GL_Master'], 'source': gl_source or file_path, 'rows': gl_master_rows, 'periods': get_periods(tables['GL_Cube'])}],
+        'batches': {},
+        'created_at': time.time(),
+    })
+
+    return row_counts
+
+
+@track_stage()
+def append_gl_batch(batch_path, file_path=DATA_FILE_PATH, chunk_size=None):
+    """
+    Appends a batch file of GL lines to an existing cache without reprocessing the workbook.
+
+    The batch replaces whatever the cache holds for the periods (Year and Month) it covers, so a
+    corrected month can simply be dropped in again. Its rows are written to their own GL_Master
+    part, the cube only swaps the rows of those periods and the balances are rolled forward from
+    the last closing balance, so adding a month costs time in proportion to that month.
+    
+    Parameters:
+    - batch_path (str): A CSV, Parquet or workbook (with a 'GL' sheet) file with the GL columns.
+    - file_path (str): The workbook the cache was built from.
+    - chunk_size (int): Rows per chunk when reading the batch; None or 0 reads it in one go.
+
+    Returns:
+    - dict: The number of rows in the cache for each table after the append.
+    """
+    paths = get_cache_paths(file_path)
+    manifest = read_cache_manifest(file_path)
+    batch_path = os.path.abspath(batch_path)
+    fingerprint = get_file_fingerprint(batch_path)
+
+    dimensions = {table: pd.read_parquet(paths[table]) for table in ['COA', 'Territory', 'Calendar']}
+    chunks = list(iter_gl_chunks(batch_path, chunk_size))
+    calendar = extend_calendar(dimensions['Calendar'], pd.concat([pd.to_datetime(chunk['Date']) for chunk in chunks]))
+    calendar_extended = calendar is not dimensions['Calendar']
+    dimensions['Calendar'] = calendar
+    batch = pd.concat([build_gl_master({**dimensions, 'GL': chunk}) for chunk in chunks], ignore_index=True)
+    batch = normalize_object_columns(batch)
+
+    # periods dropped from an edited batch are taken out of the cache along with the ones it still covers
+    part_path = paths['GL_Master'].replace('.parquet', '_' + os.path.splitext(os.path.basename(batch_path))[0] + '.parquet')
+    previous_parts = [part for part in manifest['gl_parts'] if part['path'] == part_path]
+    periods = set(get_periods(batch)).union(tuple(period) for part in previous_parts for period in part['periods'])
+
+    gl_parts = []
+    for part in manifest['gl_parts']:
+        if part['path'] == part_path:
+            continue
+        if periods.intersection(map(tuple, part['periods'])):
+            gl_part = pd.read_parquet(part['path'])
+            gl_part = gl_part[~is_in_periods(gl_part, periods)]
+            write_cache_table(gl_part, part['path'])
+            part = {**part, 'rows': len(gl_part), 'periods': [period for period in part['periods'] if tuple(period) not in periods]}
+        gl_parts.append(part)
+    write_cache_table(batch, part_path)
+    gl_parts.append({'path': part_path, 'source': batch_path, 'rows': len(batch), 'periods': get_periods(batch)})
+
+    cube = pd.read_parquet(paths['GL_Cube'])
+    # a Calendar extended with new months or quarters has more categories than the cached cube
+    cube = cube.astype({column: calendar[column].dtype for column in ['Quarter', 'Month']})
+    cube = pd.concat([cube[~is_in_periods(cube, periods)], build_gl_cube(batch, dimensions['COA'], dimensions['Territory'])], ignore_index=True)
+    cube = cube.sort_values(CUBE_KEYS, ignore_index=True)
+    balances = update_balance_table(pd.read_parquet(paths['GL_Balances']), cube, dimensions['COA'], dimensions['Territory'], min(year for year, _ in periods))
+    write_cache_table(cube, paths['GL_Cube'])
+    write_cache_table(balances, paths['GL_Balances'])
+    if calendar_extended:
+        write_cache_table(calendar, paths['Calendar'])
+        manifest['row_counts']['Calendar'] = len(calendar)
+
+    manifest['gl_parts'] = gl_parts
+    manifest['batches'][batch_path] = fingerprint
+    manifest['row_counts'].update({'GL_Master': sum(part['rows'] for part in gl_parts), 'GL_Cube': len(cube), 'GL_Balances': len(balances)})
+    write_cache_manifest(file_path, manifest)
+
+    return manifest['row_counts']
+
+
+def append_new_gl_batches(file_path=DATA_FILE_PATH, batch_dir=GL_BATCH_DIR, chunk_size=None):
+    """
+    Appends every batch file in batch_dir that is new or was edited since it was last appended.
+
+    Returns:
+    - list: The paths of the batches that were appended.
+    """
+    manifest = read_cache_manifest(file_path)
+    appended = []
+    for batch_path in list_gl_batches(batch_dir):
+        recorded = manifest['batches'].get(os.path.abspath(batch_path))
+        if recorded is None or not is_fingerprint_current(recorded, batch_path)[0]:
+            append_gl_batch(batch_path, file_path, chunk_size)
+            appended.append(batch_path)
+    return appended
+
+
+def get_table_parts(file_path=DATA_FILE_PATH, table='GL_Master'):
+    """
+    Returns the Parquet files a cached table is stored in: GL_Master is split into the rows read from the sources and one part per appended batch.
+    """
+    if table == 'GL_Master':
+        return [part['path'] for part in read_cache_manifest(file_path)['gl_parts']]
+    return [get_cache_paths(file_path)[table]]
+
+
+def get_mapped_path(part):
+    """
+    Returns the uncompressed Arrow IPC file that mirrors a cached Parquet part for memory-mapping.
+    """
+    return os.path.splitext(part)[0] + '.arrow'
+
+
+def write_mapped_table(parts, mapped_path):
+    """
+    Writes a table stored in one or more Parquet files to an uncompressed Arrow IPC file for memory-mapping.
+
+    Rows are copied in record batches of up to MAPPED_BATCH_ROWS, so peak memory is one batch
+    rather than the whole ledger, and each batch's columns are one contiguous chunk. An IPC file
+    holds one dictionary per categorical column, so a first pass over the dictionary-encoded
+    columns collects every category and each batch is re-encoded against them.
+    """
+    schema = pq.read_schema(parts[0])
+    dictionary_columns = [field.name for field in schema if pa.types.is_dictionary(field.type)]
+    dictionaries = {column: {} for column in dictionary_columns}
+    for part in parts:
+        for batch in pq.ParquetFile(part).iter_batches(columns=dictionary_columns):
+            for column in dictionary_columns:
+                for value in batch.column(column).dictionary.to_pylist():
+                    dictionaries[column].setdefault(value, len(dictionaries[column]))
+    dictionaries = {column: pa.array(list(values), schema.field(column).type.value_type) for column, values in dictionaries.items()}
+    for column, dictionary in dictionaries.items():
+        # the parts together can have more categories than the first part's index type holds
+        if len(dictionary) > np.iinfo(schema.field(column).type.index_type.to_pandas_dtype()).max:
+            schema = schema.set(schema.get_field_index(column), pa.field(column, pa.dictionary(pa.int32(), dictionary.type)))
+
+    def encode(batch):
+        columns = []
+        for field in schema:
+            column = batch.column(field.name)
+            if field.name in dictionaries:
+                codes = pc.index_in(column.dictionary, value_set=dictionaries[field.name]).cast(field.type.index_type)
+                column = pa.DictionaryArray.from_arrays(pc.take(codes, column.indices), dictionaries[field.name])
+            columns.append(column)
+        return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+    with pa.OSFile(mapped_path + '.tmp', 'wb') as sink:
+        with pa.ipc.new_file(sink, schema) as writer:
+            pending, pending_rows = [], 0
+            for part in parts:
+                for batch in pq.ParquetFile(part).iter_batches(batch_size=MAPPED_BATCH_ROWS):
+                    # small parts and batches are merged, so a table up to MAPPED_BATCH_ROWS is written as one batch
+                    if pending_rows + batch.num_rows > MAPPED_BATCH_ROWS and pending:
+                        writer.write_table(pa.Table.from_batches(pending, schema).combine_chunks())
+                        pending, pending_rows = [], 0
+                    pending.append(encode(batch))
+                    pending_rows += batch.num_rows
+            if pending:
+                writer.write_table(pa.Table.from_batches(pending, schema).combine_chunks())
+    os.replace(mapped_path + '.tmp', mapped_path)
+
+
+@track_stage()
+def read_mapped_table(file_path=DATA_FILE_PATH, table='GL_Master'):
+    """
+    Reads a cached GL table as a read-only DataFrame backed by memory-mapped Arrow files.
+
+    Each Parquet part of the table (see `get_table_parts`) has its own Arrow file, rewritten only
+    when that part is newer, so appending a batch converts the batch and not the whole ledger.
+    For a table in one part of up to MAPPED_BATCH_ROWS rows, numeric, date and categorical columns
+    are views over the mapped pages, which the operating system shares between every session and
+    process that maps the same file; pandas' copy-on-write copies a column only if something
+    tries to modify it. Tables in several parts or batches are copied when they are joined.
+    """
+    mapped_tables = []
+    for part in get_table_parts(file_path, table):
+        mapped_path = get_mapped_path(part)
+        if not os.path.exists(mapped_path) or os.path.getmtime(mapped_path) < os.path.getmtime(part):
+            write_mapped_table([part], mapped_path)
+        mapped_tables.append(pa.ipc.open_file(pa.memory_map(mapped_path)).read_all())
+    # parts can differ in their categories and dictionary index widths
+    mapped_table = mapped_tables[0] if len(mapped_tables) == 1 else pa.concat_tables(mapped_tables, promote_options='permissive')
+    return mapped_table.to_pandas(split_blocks=True)
+
+
+# one shared, read-only copy for every session instead of a pickled copy per session; the previous data version is kept until sessions move off it
+@st.cache_resource(max_entries=2)
+@track_stage('load_workbook_data')
+def _load_workbook_data(file_path, gl_source, batch_dir, chunk_size, source_stats):
+    # source_stats (path, size and mtime of every source and batch) is only part of the cache key, so an edited or new file gets a new entry
+    if not is_cache_valid(file_path, gl_source, batch_dir):
+        rebuild_data_cache(file_path, gl_source, chunk_size)
+    append_new_gl_batches(file_path, batch_dir, chunk_size)
+
+    paths = get_cache_paths(file_path)
+    tables = {table: pd.read_parquet(paths[table]) for table in CACHED_TABLES if table not in MAPPED_TABLES}
+    for table in MAPPED_TABLES:
+        tables[table] = read_mapped_table(file_path, table)
+
+    # lookups derived from the tables are cheap to build, so they are kept in memory only
+    tables['GL_Master_filter_index'] = FilterIndex(tables['GL_Master'])
+    tables['GL_Cube_filter_index'] = FilterIndex(tables['GL_Cube'])
+    tables['GL_Balances_filter_index'] = FilterIndex(tables['GL_Balances'])
+    tables['GL_Balances_lookup'] = get_balance_lookup(tables['GL_Balances'])
+    return tables
+
+
+def load_workbook_data(file_path=DATA_FILE_PATH, gl_source=GL_SOURCE_PATH, batch_dir=GL_BATCH_DIR, chunk_size=GL_CHUNK_SIZE):
+    """
+    Loads the joined GL data and every structure sheet as one unit.
+
+    The tables are shared by every session and must not be modified in place; the GL tables are
+    memory-mapped from the cache (see `read_mapped_table`). They come from the on-disk cache when it matches the workbook (and the GL
+    export, if one is configured), and are rebuilt together when a size, modification time and
+    content hash check shows that a source was edited. New or edited batch files in batch_dir
+    are appended to the cache incrementally. Use `rebuild_data_cache` to force a rebuild.
+
+    Returns:
+    - dict: 'GL_Master', 'GL_Cube', 'GL_Balances', 'COA', 'Territory', 'Calendar', 'PnL Structure', 'BS Structure'
+      and 'CF Structure', plus a '<table>_filter_index' FilterIndex for each of the three GL tables and
+      'GL_Balances_lookup', the year-end balances from `get_balance_lookup`.
+    """
+    return _load_workbook_data(*get_data_version(file_path, gl_source, batch_dir, chunk_size))
+
+
+def get_data_version(file_path=DATA_FILE_PATH, gl_source=GL_SOURCE_PATH, batch_dir=GL_BATCH_DIR, chunk_size=GL_CHUNK_SIZE):
+    """
+    Identifies the current version of the data with a small, hashable key.
+
+    The key holds the load options and the path, size and modification time of every source and
+    batch file. `load_workbook_data` uses it as its cache key, and the statement builders take it
+    instead of the tables themselves so their own caches stay cheap to hash.
+
+    Returns:
+    - tuple: The arguments of `_load_workbook_data`.
+    """
+    source_stats = []
+    for source_path in list(get_source_paths(file_path, gl_source).values()) + list_gl_batches(batch_dir):
+        fingerprint = get_file_fingerprint(source_path, with_hash=False)
+        source_stats.append((fingerprint['path'], fingerprint['size'], fingerprint['mtime_ns']))
+    return (file_path, gl_source, batch_dir, chunk_size, tuple(source_stats))
+
+
+def load_gl_transactions_data_from_excel(file_path=DATA_FILE_PATH):
+    return load_workbook_data(file_path)['GL_Master']
+
+
+HIERARCHY_COLUMNS = ['Class', 'SubClass', 'SubClass2', 'Account']
+
+
+def get_hierarchy_index(columns):
+    """
+    Returns the index columns for a statement pivot: each hierarchy column's integer sort key followed by its label.
+    """
+    return [name for column in columns for name in (column + '_SortKey', column + 'Label')]
+
+
+@track_stage()
+def prepare_statement_structure(structure, coa, columns=[]):
+    """
+    Adds a label column for each hierarchy column of a statement structure sheet.
+
+    For each column in the provided list, a new column with 'Label' appended to the original
+    column name holds the calculated name for calculated rows and the chart of accounts value
+    otherwise, as a categorical. The structure only has a few hundred rows, so the labels are
+    resolved here once instead of on every GL row; rows are ordered by the integer
+    '<column>_SortKey' columns, and HTML is only added by `format_statement_index` when rendering.
+    
+    Parameters:
+    - structure (pd.DataFrame): A structure sheet such as 'PnL Structure', keyed by Account_key.
+    - coa (pd.DataFrame): The chart of accounts, used for the labels of non-calculated rows.
+    - columns (list): A list of hierarchy column names for which labels will be generated.
+    
+    Returns:
+    - pd.DataFrame: A copy of the structure with the label columns added.
+    """
+    coa_columns = [column for column in columns if column not in structure.columns]
+    labelled = pd.merge(structure, coa[['Account_key'] + coa_columns], on='Account_key', how='left')
+
+    structure = structure.copy()
+    for column in columns:
+        label = np.where(labelled['isCalculated'] == 1, labelled['Calculated_' + column + '_Name'].astype('str'), labelled[column].astype('object'))
+        structure[column + 'Label'] = pd.Categorical(label)
+    return structure
+
+
+def get_calculated_labels(structure, columns=[]):
+    """
+    Returns, for each hierarchy column, the (sort key, label) pairs of calculated rows, which are shown in italics.
+    """
+    calculated = structure[structure['isCalculated'] == 1]
+    return {column: set(zip(calculated[column + '_SortKey'], calculated[column + 'Label'])) for column in columns}
+
+
+@track_stage()
+def format_statement_index(df, calculated_labels=None):
+    """
+    Turns the sort key / label index of a statement pivot into its display form.
+
+    The '_SortKey' levels are dropped (the rows are already in order) and the label levels are
+    renamed back to the hierarchy column names. When calculated_labels is given, the labels of
+    calculated rows are wrapped in <i> tags; only the final statement's rows are touched.
+    """
+    index = df.index.to_frame(index=False)
+    for name in list(index.columns):
+        if not isinstance(name, str) or not name.endswith('_SortKey'):
+            continue
+        column = name[:-len('_SortKey')]
+        labels = index[column + 'Label'].astype('object')
+        if calculated_labels:
+            is_calculated = [(key, label) in calculated_labels.get(column, ()) for key, label in zip(index[name], labels)]
+            labels = labels.where(~np.array(is_calculated, dtype=bool), '<i>' + labels.astype('str') + '</i>')
+        index[column + 'Label'] = labels
+        index = index.drop(columns=name).rename(columns={column + 'Label': column})
+
+    df = df.copy()
+    df.index = pd.MultiIndex.from_frame(index) if index.shape[1] > 1 else pd.Index(index.iloc[:, 0])
+    return df
+
+
+def format_amounts(values):
+    """
+    Formats amounts exactly like `amount_formatter` (thousands separators, two decimals, negatives in
+    parentheses), with '-' for missing values, using array operations instead of a call per cell.
+    """
+    values = np.asarray(values, dtype='float64')
+    missing = np.isnan(values)
+    # printf rounding matches str.format on exact half-cent ties
+    digits = np.char.partition(np.char.mod('%.2f', np.abs(np.where(missing, 0, values))), '.')
+    whole = digits[..., 0].astype('int64')
+
+    text = np.where(whole >= 1000, np.char.mod('%03d', whole % 1000), np.char.mod('%d', whole % 1000))
+    remaining = whole // 1000
+    while (remaining > 0).any():
+        higher = remaining // 1000
+        group = np.where(higher > 0, np.char.mod('%03d', remaining % 1000), np.char.mod('%d', remaining % 1000))
+        text = np.where(remaining > 0, np.char.add(np.char.add(group, ','), text), text)
+        remaining = higher
+
+    text = np.char.add(np.char.add(text, '.'), digits[..., 2])
+    text = np.where(values < 0, np.char.add(np.char.add('(', text), ')'), text)
+    return np.where(missing, '-', text)
+
+
+@track_stage()
+def render_statement_html(df, formatter=amount_formatter):
+    """
+    Renders a statement whose index is already in display form as an HTML table.
+
+    The values are formatted up front, vectorized for `amount_formatter`, and right-aligned with
+    a single table-level style rather than one style rule per cell.
+    """
+    if formatter is amount_formatter:
+        values = format_amounts(df.to_numpy(dtype='float64'))
+    else:
+        values = df.map(lambda value: '-' if pd.isna(value) else formatter(value)).to_numpy()
+    formatted = pd.DataFrame(values, index=df.index, columns=df.columns)
+    return formatted.style.set_table_styles([{'selector': 'td', 'props': 'text-align: right;'}]).to_html()
+
+
+_rendered_fragments = {}
+_rendered_fragments_lock = threading.Lock()
+
+
+def get_rendered_fragment(df, part, render):
+    """
+    Returns the rendered HTML of one part of a statement, rendering it only the first time.
+
+    Fragments are kept per statement object, so a statement served from the StatementCache is
+    rendered once per page however many sessions show it, and its fragments are dropped when it
+    is evicted from that cache.
+    """
+    statement_id = id(df)
+    with _rendered_fragments_lock:
+        fragments = _rendered_fragments.get(statement_id)
+        if fragments is None:
+            fragments = _rendered_fragments[statement_id] = {}
+            weakref.finalize(df, _rendered_fragments.pop, statement_id, None)
+        if part in fragments:
+            return fragments[part]
+
+    html = render()
+    with _rendered_fragments_lock:
+        fragments[part] = html
+    return html
+
+
+def print_df_to_dashboard(df, st=st, formatter=amount_formatter, calculated_labels=None, page_rows=DASHBOARD_PAGE_ROWS, key='statement'):
+    """
+    Writes a statement pivot to the dashboard as an HTML table.
+
+    A statement longer than page_rows is split into collapsible groups by the top level of its
+    hierarchy. Only the expanded groups are rendered and sent to the browser, page_rows rows at
+    a time. Rendered pages are cached per statement object (see `get_rendered_fragment`).
+    
+    Parameters:
+    - df (pd.DataFrame): The statement pivot, with the sort key / label index.
+    - st: The Streamlit module or container to write to.
+    - formatter (function): Formats a single value; `amount_formatter` is applied vectorized.
+    - calculated_labels (dict): The output of `get_calculated_labels`, to italicize calculated rows.
+    - page_rows (int): The most rows rendered in one table.
+    - key (str): Prefix for the widget keys of the groups and pagers; unique per statement on the page.
+    """
+    labels_key = tuple(sorted((column, frozenset(labels)) for column, labels in (calculated_labels or {}).items()))
+    display_df = get_rendered_fragment(df, ('index', labels_key), lambda: format_statement_index(df, calculated_labels))
+
+    if len(df) <= page_rows:
+        html = get_rendered_fragment(df, (formatter, labels_key, None, 0), lambda: render_statement_html(display_df, formatter))
+        st.write(html, unsafe_allow_html=True)
+        return
+
+    group_positions = display_df.groupby(level=0, sort=False, observed=True).indices
+    for group_number, (group, positions) in enumerate(group_positions.items()):
+        group_label = re.sub(r'</?i>', '', str(group))
+        expander = st.expander(f"{group_label} ({len(positions)} rows)", expanded=group_number == 0, key=f"{key}:{group_label}", on_change='rerun')
+        if not expander.open:
+            continue
+        page_count = -(-len(positions) // page_rows)
+        page = 1
+        if page_count > 1:
+            page = expander.number_input(f"Page (of {page_count})", min_value=1, max_value=page_count, key=f"{key}:{group_label}:page")
+        page_positions = positions[(page - 1) * page_rows:page * page_rows]
+        html = get_rendered_fragment(df, (formatter, labels_key, group_label, page), lambda: render_statement_html(display_df.iloc[page_positions], formatter))
+        expander.write(html, unsafe_allow_html=True)
+
+
+class FilterIndex:
+    """
+    Maps each value of the filter columns of a DataFrame to the sorted positions of its rows.
+
+    Built once when the data is loaded, so a filter selection is answered by intersecting the
+    precomputed positions instead of scanning every row. Answers are memoized per selection.
+    The index is shared by every session, so the memo is guarded by a lock and the returned
+    positions are read-only.
+    """
+
+    def __init__(self, df, columns=('Year', 'Region', 'Country'), max_memoized=64):
+        self.row_count = len(df)
+        self.positions = {}
+        for column in columns:
+            codes, uniques = pd.factorize(df[column])
+            # a stable sort keeps each value's positions in ascending order; missing values (-1) come first
+            order = np.argsort(codes, kind='stable').astype('int32')
+            counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+            value_positions = np.split(order[(codes < 0).sum():], np.cumsum(counts)[:-1])
+            self.positions[column] = dict(zip(uniques.tolist(), value_positions))
+        self.values = {column: sorted(self.positions[column]) for column in columns}
+
+        self.max_memoized = max_memoized
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_values(self, column):
+        """
+        Returns the distinct non-missing values of a filter column in sorted order, e.g. for the sidebar filter options.
+        """
+        return self.values[column]
+
+    def get_positions(self, filter_maps={}):
+        """
+        Returns the sorted positions of the rows matching every filter, or None when nothing is filtered.
+
+        Parameters:
+        - filter_maps (dict): Column name to the list of accepted values; an empty list accepts everything.
+        """
+        key = tuple((column, frozenset(values)) for column, values in filter_maps.items() if len(values) > 0)
+        if not key:
+            return None
+        with self._lock:
+            if key in self._memo:
+                self._memo.move_to_end(key)
+                return self._memo[key]
+
+        positions = None
+        for column, values in key:
+            column_positions = [self.positions[column][value] for value in values if value in self.positions[column]]
+            column_positions = np.sort(np.concatenate(column_positions)) if column_positions else np.array([], dtype='int32')
+            positions = column_positions if positions is None else np.intersect1d(positions, column_positions, assume_unique=True)
+        positions.setflags(write=False)
+
+        with self._lock:
+            self._memo[key] = positions
+            if len(self._memo) > self.max_memoized:
+                self._memo.popitem(last=False)
+        return positions
+
+
+@track_stage()
+def apply_global_filters(df, year, region, country, filter_index=None):
+    """
+    Filters a DataFrame by the sidebar Year, Region and Country selections; an empty selection keeps every row.
+
+    When a FilterIndex built from the same DataFrame is given, the rows are taken from its
+    precomputed positions instead of comparing every row.
+    """
+    if filter_index is not None:
+        positions = filter_index.get_positions({'Year': year, 'Region': region, 'Country': country})
+        return df if positions is None else df.iloc[positions]
+    return df[(df['Year'].isin(year) | (len(year) == 0)) & (df['Country'].isin(country) | (len(country) == 0))& (df['Region'].isin(region) | (len(region) == 0))]
+
+
+def filter_df_by_index_values(df, index_level, slice_value=[]):
+    """
+    Sums the rows of a DataFrame whose label at the specified index level is one of slice_value.
+    """
+    matches = df.index.get_level_values(index_level).isin(slice_value)
+
+    result = df[matches]
+
+    result = result.sum().to_frame().T
+
+    result = result.reset_index(drop=True)
+
+    return result
+
+
+class StatementIndex:
+    """
+    Maps the labels at every level of a statement pivot's index to the positions of its rows.
+
+    Built once per pivot, so any number of statement lines (e.g. Gross Profit, Sales, EBITDA)
+    can be summed by position instead of rescanning the index for each lookup.
+    """
+
+    def __init__(self, df):
+        self.columns = df.columns
+        self.values = df.to_numpy(dtype='float64')
+        self.positions = {}
+        for level, name in enumerate(df.index.names):
+            codes, uniques = pd.factorize(df.index.get_level_values(level))
+            self.positions[name] = {label: np.flatnonzero(codes == code) for code, label in enumerate(uniques.tolist())}
+
+    def get_positions(self, index_level, labels=[]):
+        level_positions = self.positions[index_level]
+        positions = [level_positions[label] for label in labels if label in level_positions]
+        return np.unique(np.concatenate(positions)) if positions else np.array([], dtype='int64')
+
+    def sum_labels(self, lookups={}):
+        """
+        Sums the rows for a batch of lookups in one call.
+
+        Parameters:
+        - lookups (dict): Name of each result row to an (index_level, labels) pair.
+
+        Returns:
+        - pd.DataFrame: One row per lookup, with the pivot's columns.
+        """
+        sums = [np.nansum(self.values[self.get_positions(index_level, labels)], axis=0) for index_level, labels in lookups.values()]
+        return pd.DataFrame(np.array(sums).reshape(len(sums), len(self.columns)), index=list(lookups), columns=self.columns)
+
+
+# sign multiplier and the Sign a row must have (None for any) for each flow ValueType in the CF structure
+CASH_FLOW_VALUE_TYPE_RULES = {
+    'All_FTP': (1, None),
+    'All_FTP_CS': (-1, None),
+    'All_FTP_Positive': (1, 'Positive'),
+    'All_FTP_Negative': (1, 'Negative'),
+    'All_FTP_Positive_CS': (-1, 'Positive'),
+    'All_FTP_Negative_CS': (-1, 'Negative'),
+}
+
+
+@track_stage()
+def transform_cash_flow_values(cash_flow_df, years):
+    """
+    Applies the cash flow ValueType rules to a pivot with one column per year.
+
+    Flow rows are multiplied by the sign in CASH_FLOW_VALUE_TYPE_RULES (0 when the row's Sign
+    does not match), 'Closing_balance' rows become a running total across the years and
+    'Opening_balance' rows the running total up to the previous year.
+    
+    Parameters:
+    - cash_flow_df (pd.DataFrame): One row per CF line with 'ValueType', 'Sign' and a column per year.
+    - years (list): The year columns, in chronological order.
+    
+    Returns:
+    - pd.DataFrame: A copy of cash_flow_df with the year columns transformed.
+    """
+    values = cash_flow_df[years].to_numpy(dtype='float64')
+    value_type = cash_flow_df['ValueType'].to_numpy()
+    sign = cash_flow_df['Sign'].to_numpy()
+
+    multiplier = np.zeros(len(cash_flow_df))
+    for rule_value_type, (rule_multiplier, rule_sign) in CASH_FLOW_VALUE_TYPE_RULES.items():
+        mask = value_type == rule_value_type
+        if rule_sign is not None:
+            mask &= sign == rule_sign
+        multiplier[mask] = rule_multiplier
+
+    # rows whose rule does not apply are zero even when the year has no value
+    transformed = np.where(multiplier[:, None] == 0, 0.0, values * multiplier[:, None])
+
+    # np.cumsum (unlike DataFrame.cumsum) carries a missing year forward as NaN, as the original loop did
+    running_total = np.cumsum(values, axis=1)
+    is_closing = value_type == 'Closing_balance'
+    transformed[is_closing] = running_total[is_closing]
+
+    is_opening = value_type == 'Opening_balance'
+    transformed[is_opening] = np.hstack([np.zeros((len(values), 1)), running_total[:, :-1]])[is_opening]
+
+    result = cash_flow_df.copy()
+    result[years] = transformed
+    return result
+
+
+def filter_df_by_column_values(df, filter_maps={}):
+    for column, filter in filter_maps.items():
+        df = df[(df[column].isin(filter))]
+    
+    return df 
+
+
+def sum_filtered_values(df, filter_maps={}, amount_column_name="Amount"):
+    df = filter_df_by_column_values(df, filter_maps)
+    return df['Amount'].sum()
+
+
+class KPIService:
+    """
+    Serves the P&L metric cards from a single grouped aggregation by (Year, measure column).
+
+    The GL is filtered by Region and Country only and summed once per Year and measure, so the
+    to-date, for-the-period, prior-year and multi-year figures all come from the same table.
+    """
+
+    def __init__(self, df, region=[], country=[], filter_index=None, measure_column='SubClass'):
+        filtered = apply_global_filters(df, [], region, country, filter_index=filter_index)
+        self.by_year = filtered.groupby(['Year', measure_column], observed=True)['Amount'].sum().unstack(fill_value=0)
+
+    def get_values(self, measures):
+        """
+        Returns the total of one or more measures for every year in the data.
+        """
+        measures = [measures] if isinstance(measures, str) else measures
+        return self.by_year.reindex(columns=measures, fill_value=0).sum(axis=1)
+
+    def ttd(self, measures):
+        return self.get_values(measures).sum()
+
+    def ftp(self, measures, year):
+        return self.get_values(measures).get(year, 0)
+
+
+# base measures as hierarchy selectors, after reference_work_by_irfan/ratios_with_pivot.py; an account belongs to a measure if any of its
+# selectors match. 'flow' measures are the movements of a period, 'balance' measures the closing balance at its end
+MEASURES = {
+    'Sales': ('flow', {'SubClass': ['Sales']}),
+    'Cost of Sales': ('flow', {'SubClass': ['Cost of Sales']}),
+    'Gross Profit': ('flow', {'Class': ['Trading account']}),
+    'EBITDA': ('flow', {'SubClass': ['Sales', 'Cost of Sales', 'Operating Expenses']}),
+    'Operating Profit': ('flow', {'Class': ['Trading account', 'Operating account']}),
+    'PBIT': ('flow', {'Class': ['Trading account', 'Operating account', 'Non-operating']}),
+    'Net Profit': ('flow', {'Report': ['Profit and Loss']}),
+    'Interest Expense': ('flow', {'SubClass': ['Interest Expense']}),
+    'Assets': ('balance', {'Class': ['Assets']}),
+    'Current Assets': ('balance', {'SubClass2': ['Current Assets']}),
+    'Non-Current Assets': ('balance', {'SubClass2': ['Non-Current Assets']}),
+    'Current Liabilities': ('balance', {'SubClass2': ['Current Liabilities']}),
+    'Non-Current Liabilities': ('balance', {'SubClass2': ['Long Term Liabilities']}),
+    'Equity': ('balance', {'SubClass': ['Owners Equity']}),
+    'Capital Employed': ('balance', {'SubClass': ['Owners Equity'], 'SubClass2': ['Long Term Liabilities']}),
+    'Inventory': ('balance', {'Account': ['Inventory']}),
+    'Trade Receivables': ('balance', {'SubAccount': ['Trade Receivables']}),
+    'Trade Payables': ('balance', {'SubAccount': ['Trade Payables']}),
+}
+
+# ratios as formulas over the base measures (m is a DataFrame with one column per measure) and the unit they are shown in
+RATIOS = {
+    'Gross Margin': (lambda m: m['Gross Profit'] / m['Sales'] * 100, '%'),
+    'EBITDA Margin': (lambda m: m['EBITDA'] / m['Sales'] * 100, '%'),
+    'Operating Margin': (lambda m: m['Operating Profit'] / m['Sales'] * 100, '%'),
+    'Net Margin': (lambda m: m['Net Profit'] / m['Sales'] * 100, '%'),
+    'ROCE': (lambda m: m['PBIT'] / m['Capital Employed'] * 100, '%'),
+    'ROE': (lambda m: m['Net Profit'] / m['Equity'] * 100, '%'),
+    'Asset Turnover': (lambda m: (m['Sales'] / m['Assets']).abs(), 'x'),
+    'Current Ratio': (lambda m: (m['Current Assets'] / m['Current Liabilities']).abs(), 'x'),
+    'Quick Ratio': (lambda m: ((m['Current Assets'] - m['Inventory']) / m['Current Liabilities']).abs(), 'x'),
+    'Interest Cover': (lambda m: (m['PBIT'] / m['Interest Expense']).abs(), 'x'),
+    'Gearing': (lambda m: (m['Non-Current Liabilities'] + m['Current Liabilities']) / m['Equity'] * 100, '%'),
+    'Receivables Days': (lambda m: (m['Trade Receivables'] / m['Sales'] * 365).abs(), 'days'),
+    'Inventory Days': (lambda m: (m['Inventory'] / m['Cost of Sales'] * 365).abs(), 'days'),
+    'Payables Days': (lambda m: (m['Trade Payables'] / m['Cost of Sales'] * 365).abs(), 'days'),
+}
+
+
+def get_measure_membership(coa, measures=MEASURES):
+    """
+    Returns a boolean account x measure matrix: True where an account is included in a measure.
+    """
+    membership = {}
+    for measure, (_, selectors) in measures.items():
+        selected = np.zeros(len(coa), dtype=bool)
+        for column, values in selectors.items():
+            selected |= coa[column].isin(values).to_numpy()
+        membership[measure] = selected
+    return pd.DataFrame(membership, index=coa['Account_key'])
+
+
+class MeasureEngine:
+    """
+    Computes every base measure from one aggregation of the GL cube and derives the ratios from them.
+
+    The cube is summed once by period and account; multiplying that by the account x measure
+    membership matrix gives all base measures at once, balance measures are cumulated into
+    closing balances, and each ratio is vectorized arithmetic over the resulting columns. A new
+    ratio is one more entry in RATIOS.
+    
+    Parameters:
+    - cube (pd.DataFrame): The GL cube.
+    - coa (pd.DataFrame): The chart of accounts.
+    - region (list), country (list): The sidebar selections; an empty list keeps every territory.
+    - filter_index (FilterIndex): The cube's FilterIndex.
+    - period_columns (list): The TIME_GRAINS columns of the grain, e.g. ['Year', 'Quarter'] for quarterly figures.
+    - periods (pd.DataFrame): The grain's `get_calendar_periods`, to put the periods in date order; months
+      are categorical in alphabetical order, so this is needed for the monthly grain.
+    """
+
+    def __init__(self, cube, coa, region=[], country=[], filter_index=None, period_columns=['Year'], periods=None, measures=MEASURES, ratios=RATIOS):
+        # balances need every earlier period, so only the territory filters apply
+        filtered = apply_global_filters(cube, [], region, country, filter_index=filter_index)
+        amounts = filtered.groupby(period_columns + ['Account_key'], observed=True)['Amount'].sum().unstack('Account_key', fill_value=0)
+        if periods is not None and len(period_columns) > 1:
+            period_order = pd.MultiIndex.from_frame(periods[period_columns])
+            amounts = amounts.reindex(period_order[period_order.isin(amounts.index)])
+
+        membership = get_measure_membership(coa, measures).reindex(amounts.columns, fill_value=False)
+        values = pd.DataFrame(amounts.to_numpy() @ membership.to_numpy(dtype='float64'), index=amounts.index, columns=membership.columns)
+        balance_measures = [measure for measure, (kind, _) in measures.items() if kind == 'balance']
+        values[balance_measures] = values[balance_measures].cumsum()
+
+        self.units = {measure: '' for measure in measures}
+        self.units.update({ratio: unit for ratio, (_, unit) in ratios.items()})
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio_values = pd.DataFrame({ratio: formula(values) for ratio, (formula, _) in ratios.items()}, index=values.index)
+        self.values = pd.concat([values, ratio_values.replace([np.inf, -np.inf], np.nan)], axis=1)
+
+    def get_value(self, name, period):
+        return self.values[name].get(period, np.nan)
+
+
+def format_measure(value, unit=''):
+    if pd.isna(value):
+        return '-'
+    if unit == '%':
+        return f"{value:,.1f}%"
+    if unit == 'x':
+        return f"{value:,.2f}x"
+    if unit == 'days':
+        return f"{value:,.0f} days"
+    return stylize(value)
+
+
+class TransactionBrowser:
+    """
+    Answers the Transaction Details tab's filter, sort and paging requests on the server.
+
+    Shared by every session for one data version. Each query's row positions are memoized, so
+    turning pages only slices out the rows of the visible page, and the order of the ledger by
+    each sort column is computed once and then reused for every filter.
+    """
+
+    def __init__(self, df, filter_index=None, max_memoized=16):
+        self.df = df
+        self.filter_index = filter_index
+        self.columns = list(df.columns)
+        self.max_memoized = max_memoized
+        self._sort_orders = {}
+        self._domains = {}
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_column_domain(self, column):
+        """
+        Describes how a column can be filtered.
+
+        Returns:
+        - tuple: ('values', categories) for categorical columns, ('range', (min, max)) for numeric and
+          date columns, or ('text', None) for free text matched with a case-insensitive substring search.
+        """
+        with self._lock:
+            if column in self._domains:
+                return self._domains[column]
+        series = self.df[column]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            domain = ('values', series.cat.categories.tolist())
+        elif pd.api.types.is_numeric_dtype(series) or pd.api.types.is_datetime64_any_dtype(series):
+            domain = ('range', (series.min(), series.max()))
+        else:
+            domain = ('text', None)
+        with self._lock:
+            self._domains[column] = domain
+        return domain
+
+    def get_sort_order(self, column, ascending=True):
+        key = (column, ascending)
+        with self._lock:
+            if key in self._sort_orders:
+                return self._sort_orders[key]
+        order = self.df[column].reset_index(drop=True).sort_values(ascending=ascending, kind='stable', na_position='last').index.to_numpy()
+        order.setflags(write=False)
+        with self._lock:
+            self._sort_orders[key] = order
+        return order
+
+    @track_stage('transactions_query')
+    def query(self, filters, column_filters={}, sort_by=None, ascending=True):
+        """
+        Returns the positions of the matching rows, in display order.
+
+        Parameters:
+        - filters (tuple): The (year, region, country) sidebar selections, answered from the FilterIndex.
+        - column_filters (dict): Column name to accepted values (list), an inclusive (low, high) range (tuple)
+          or a substring (str); empty filters are ignored.
+        - sort_by (str): Column to sort by; None keeps the ledger order.
+        - ascending (bool): The sort direction.
+        """
+        column_filters = {column: condition for column, condition in column_filters.items() if condition not in (None, '', [], ())}
+        key = (to_cache_key(filters), tuple((column, to_cache_key(condition)) for column, condition in column_filters.items()), sort_by, ascending)
+        with self._lock:
+            if key in self._memo:
+                self._memo.move_to_end(key)
+                return self._memo[key]
+
+        year, region, country = filters
+        positions = None
+        if self.filter_index is not None:
+            positions = self.filter_index.get_positions({'Year': year, 'Region': region, 'Country': country})
+        if positions is None:
+            positions = np.arange(len(self.df))
+        for column, condition in column_filters.items():
+            values = self.df[column].iloc[positions]
+            if isinstance(condition, str):
+                mask = values.astype('str').str.contains(condition, case=False, regex=False, na=False)
+            elif isinstance(condition, tuple):
+                mask = values.between(*condition)
+            else:
+                mask = values.isin(condition)
+            positions = positions[np.asarray(mask)]
+
+        if sort_by is not None:
+            order = self.get_sort_order(sort_by, ascending)
+            selected = np.zeros(len(self.df), dtype=bool)
+            selected[positions] = True
+            positions = order[selected[order]]
+        positions.setflags(write=False)
+
+        with self._lock:
+            self._memo[key] = positions
+            if len(self._memo) > self.max_memoized:
+                self._memo.popitem(last=False)
+        return positions
+
+    def get_page(self, positions, page=1, page_rows=TRANSACTION_PAGE_ROWS):
+        return self.df.iloc[positions[(page - 1) * page_rows:page * page_rows]]
+
+    @track_stage('transactions_export')
+    def export(self, positions, file_format='csv', chunk_rows=50000):
+        """
+        Writes the rows at positions to a temporary CSV or Parquet file, chunk_rows rows at a time.
+
+        Returns:
+        - file: The file, rewound, for `st.download_button`; only one chunk of rows is held in memory while writing.
+        """
+        output = tempfile.TemporaryFile()
+        writer = None
+        for start in range(0, max(len(positions), 1), chunk_rows):
+            chunk = self.df.iloc[positions[start:start + chunk_rows]]
+            if file_format == 'csv':
+                output.write(chunk.to_csv(index=False, header=start == 0).encode('utf-8'))
+            else:
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(output, table.schema)
+                writer.write_table(table)
+        if writer is not None:
+            writer.close()
+        output.seek(0)
+        return output
+
+
+@st.cache_resource(max_entries=2)
+def get_transaction_browser(data_version):
+    workbook_data = _load_workbook_data(*data_version)
+    return TransactionBrowser(workbook_data['GL_Master'], workbook_data['GL_Master_filter_index'])
+
+
+class StatementCache:
+    """
+    Bounded LRU cache of built statements, shared by every session.
+
+    Entries are keyed on (statement, data version, arguments). The least recently used entries
+    are evicted once there are more than max_entries of them or their DataFrames take more than
+    max_bytes. Cached statements are shared, so callers must not modify them in place.
+    """
+
+    def __init__(self, max_entries=STATEMENT_CACHE_MAX_ENTRIES, max_bytes=STATEMENT_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
 
+    def get_or_build(self, key, build):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            self.misses += 1
 
-def print_df_to_dashboard(df, st=st, formatter=amount_formatter):
-    if len(df.index.names) > 0:
-        df.index.names = [x.replace('Sorted', '') if x else None for x in df.index.names]
+        # built outside the lock so sessions building different statements do not wait on each other
+        value = build()
+        size = get_object_size(value)
 
-    df_styled = df.style.format(
-                                na_rep='-',
-                                formatter= formatter,
-                            ).set_properties(**{'text-align': 'right'})
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (value, size)
+                self.size_bytes += size
+                while len(self._entries) > self.max_entries or (self.size_bytes > self.max_bytes and len(self._entries) > 1):
+                    _, (_, evicted_size) = self._entries.popitem(last=False)
+                    self.size_bytes -= evicted_size
+                    self.evictions += 1
+        return value
 
-    st.write(df_styled.to_html(index=False), unsafe_allow_html=True)
-    return df_styled
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'size_mb': self.size_bytes / 2**20,
+            }
 
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
 
-def generated_sorted_column(df, columns=[]):
+
+def get_object_size(value):
     """
-    Adds sorted columns to the DataFrame based on specified columns and sort keys.
-    
-    For each column in the provided list, the function creates a new column with 'Sorted'
-    appended to the original column name. This new column contains a combination of a hidden sort key
-    and the original column's value or a calculated name, formatted with HTML for display purposes.
-    
+    Returns the approximate memory used by a DataFrame, Series, or a tuple or list of them.
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(np.sum(value.memory_usage(deep=True)))
+    if isinstance(value, (tuple, list)):
+        return sum(get_object_size(item) for item in value)
+    return sys.getsizeof(value)
+
+
+@st.cache_resource
+def get_statement_cache():
+    return StatementCache()
+
+
+def to_cache_key(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(to_cache_key(item) for item in value)
+    return value
+
+
+def memoize_statement(build):
+    """
+    Caches a statement builder's results in the shared StatementCache.
+
+    The builder's first argument must be the data version from `get_data_version`; the others
+    are the small selections (filters, level of detail, comparison columns) that the statement
+    depends on.
+    """
+    @functools.wraps(build)
+    def wrapper(data_version, *args):
+        key = (build.__name__, data_version, to_cache_key(args))
+        with measure_stage(build.__name__) as record:
+            # the stage shows whether the statement was built or served from the cache
+            record['cached'] = True
+            def run_build():
+                record['cached'] = False
+                return build(data_version, *args)
+            record['output'] = get_statement_cache().get_or_build(key, run_build)
+            return record['output']
+    return wrapper
+
+
+@memoize_statement
+def build_income_statement(data_version, filters, level_of_detail, comparison_by, time_grain='Year', query_backend=QUERY_BACKEND):
+    """
+    Builds the P&L pivot for the selected filters, level of detail, comparison columns and time grain.
+
+    Memoized in the shared StatementCache, so switching back to a combination that any session
+    has already shown costs nothing.
+
     Parameters:
-    - df (pd.DataFrame): The DataFrame to which the sorted columns will be added.
-    - columns (list): A list of column names for which sorted columns will be generated.
-    
+    - data_version (tuple): The output of `get_data_version`, identifying the cached tables to use.
+    - filters (tuple): The (year, region, country) sidebar selections.
+    - level_of_detail (list): The hierarchy index from `get_hierarchy_index`.
+    - comparison_by (list): The column dimensions.
+    - time_grain (str): A TIME_GRAINS key; below 'Year', the 'Year' column is split into the grain's periods.
+    - query_backend (str): A QUERY_BACKENDS name; 'duckdb' filters, joins and sums the cube in SQL.
+
     Returns:
-    - pd.DataFrame: The modified DataFrame with added sorted columns.
-    """    
-    for column in columns:
-        df[column + 'Sorted'] = '<span style="display:none;">' + df[column + '_SortKey'].astype('str').str.pad(2, side='left', fillchar='0') + ' - </span>' + np.where(df['isCalculated'] == 1, '<i>'+df['Calculated_' + column + '_Name'].astype('str')+'</i>', df[column]) 
-    return df 
+    - tuple: (income statement with row and column totals, calculated labels for `print_df_to_dashboard`).
+    """
+    workbook_data = _load_workbook_data(*data_version)
+    pnl_structure = prepare_statement_structure(workbook_data['PnL Structure'], workbook_data['COA'], HIERARCHY_COLUMNS)
+    periods = get_calendar_periods(workbook_data['Calendar'], time_grain) if time_grain != 'Year' else None
+    if query_backend == 'duckdb':
+        # only the totals per statement line and column come back from the SQL engine
+        pnl_gl_cube = query_statement_totals(data_version, 'GL_Cube', pnl_structure, filters, level_of_detail + get_period_comparison(comparison_by, time_grain),
+                                             'Amount', periods, time_grain)
+    else:
+        pnl_gl_cube = get_statement_cube(data_version, 'PnL Structure', filters)
+        if periods is not None:
+            pnl_gl_cube = pd.merge(pnl_gl_cube, periods, on=TIME_GRAINS[time_grain], how='inner', suffixes=('', ''))
 
+    # the pivot comes out ordered by the integer sort keys and the periods' date order
+    income_statement_df = pd.pivot_table(pnl_gl_cube, index=level_of_detail, values='Amount', columns=get_period_comparison(comparison_by, time_grain),
+                                aggfunc='sum', margins=True, observed=True, margins_name='Total'
+                            )
 
-def apply_global_filters(df, year, region, country):
-    return df[(df['Year'].isin(year) | (len(year) == 0)) & (df['Country'].isin(country) | (len(country) == 0))& (df['Region'].isin(region) | (len(region) == 0))]
+    # removing the grand total row at the bottom
+    return income_statement_df.iloc[:-1, :], get_calculated_labels(pnl_structure, HIERARCHY_COLUMNS)
 
 
-def filter_df_by_index_values(df, index_level, slice_value=[]):
+@memoize_statement
+def build_income_statement_lines(data_version, filters):
     """
-    Filters a DataFrame by cleaning a specified level of its multi-index and then slicing by a given value.
+    Sums the P&L lines used by the Quick Insights charts (Gross Profit, Sales, Net Profit and EBITDA) by year.
     """
-    # Extract the specified level of the index and clean it
+    pnl_gl_cube = get_statement_cube(data_version, 'PnL Structure', filters)
+    income_statement_df_for_analysis = pd.pivot_table(pnl_gl_cube, index=get_hierarchy_index(['Class', 'SubClass', 'SubClass2']), values='Amount', columns=['Year'],
+                            aggfunc='sum', observed=True
+                        )
+    income_statement_df_for_analysis = format_statement_index(income_statement_df_for_analysis)
 
-    df_index = df.index.get_level_values(index_level)
-    cleaned_index = df_index.str.replace('<span style="display:none;">\d+ - </span>', '', regex=True)
-    cleaned_index = cleaned_index.str.replace('<i>', '')
-    cleaned_index = cleaned_index.str.replace('</i>', '')
-    
-    # Identify keys after cleaning that match the specified slice_value
-    matches = cleaned_index.isin(slice_value)
-    
-    # Convert the boolean array to the original index keys
-    keys_to_search = df.index[matches]
-    
-    # Use the filtered keys to access rows in the original DataFrame
-    result =  df.loc[keys_to_search]
+    return StatementIndex(income_statement_df_for_analysis).sum_labels({
+        'Gross Profit': ('Class', ['Gross Profit']),
+        'Sales': ('SubClass', ['Sales']),
+        'Net Profit': ('Class', ['Net Profit']),
+        'EBITDA': ('SubClass', ['Sales', 'Cost of Sales', 'Operating Expenses']),
+    })
 
-    result = result.sum().to_frame().T
 
-    result = result.reset_index(drop=True)
+@memoize_statement
+def build_sales_by_region(data_version, region, country):
+    """
+    Sums the sales by region and year for every year, ignoring the year filter.
+    """
+    workbook_data = _load_workbook_data(*data_version)
+    sales_df = apply_global_filters(workbook_data['GL_Cube'], region=region, country=country, year=[], filter_index=workbook_data['GL_Cube_filter_index'])
+    sales_df = sales_df[sales_df['SubClass'] == 'Sales']
+    sales_df = pd.pivot_table(sales_df, index=['Region', 'Year'], values='Amount', aggfunc='sum', observed=True)
+    return sales_df.reset_index()
 
-    return result
 
+@memoize_statement
+def build_period_balances(data_version, time_grain):
+    """
+    Computes the closing balances at each period end of a time grain finer than 'Year'.
 
-def filter_df_by_column_values(df, filter_maps={}):
-    for column, filter in filter_maps.items():
-        df = df[(df[column].isin(filter))]
-    
-    return df 
+    The periods run densely from the first posting to the last one, so a quarter or month
+    without postings still shows the balance carried forward.
+
+    Returns:
+    - pd.DataFrame: The `build_balance_table` rows with the grain's columns and 'Period' label attached.
+    """
+    workbook_data = _load_workbook_data(*data_version)
+    periods = get_calendar_periods(workbook_data['Calendar'], time_grain)
+    period_cube = pd.merge(workbook_data['GL_Cube'][['Account_key', 'Territory_key', 'Amount'] + TIME_GRAINS[time_grain]], periods,
+                           on=TIME_GRAINS[time_grain], how='inner', suffixes=('', ''))
 
+    all_periods = periods['Period_SortKey'][periods['Period_SortKey'] <= period_cube['Period_SortKey'].max()].tolist()
+    balances = build_balance_table(period_cube, workbook_data['COA'], workbook_data['Territory'], ['Period_SortKey'], all_periods)
+    return pd.merge(balances, periods, on='Period_SortKey', how='inner', suffixes=('', ''))
 
-def sum_filtered_values(df, filter_maps={}, amount_column_name="Amount"):
-    df = filter_df_by_column_values(df, filter_maps)
-    return df['Amount'].sum()
+
+@memoize_statement
+def build_balance_sheet(data_version, filters, level_of_detail, comparison_by, time_grain='Year', query_backend=QUERY_BACKEND):
+    """
+    Builds the balance sheet pivot from the precomputed year-end balances, or the period-end
+    balances of a finer time grain.
+
+    Returns:
+    - tuple: (balance sheet, calculated labels for `print_df_to_dashboard`).
+    """
+    workbook_data = _load_workbook_data(*data_version)
+    bs_structure = prepare_statement_structure(workbook_data['BS Structure'], workbook_data['COA'], HIERARCHY_COLUMNS)
+
+    # prune the precomputed balances with the global filters before attaching the structure
+    if query_backend == 'duckdb':
+        balances = 'GL_Balances' if time_grain == 'Year' else build_period_balances(data_version, time_grain)
+        bs_balances = query_statement_totals(data_version, balances, bs_structure, filters, level_of_detail + get_period_comparison(comparison_by, time_grain), 'Balance')
+    else:
+        if time_grain == 'Year':
+            filtered_balances = apply_global_filters(workbook_data['GL_Balances'], *filters, filter_index=workbook_data['GL_Balances_filter_index'])
+        else:
+            filtered_balances = apply_global_filters(build_period_balances(data_version, time_grain), *filters)
+        bs_balances = pd.merge(filtered_balances, bs_structure, left_on='Account_key', right_on='Account_key', how='inner', suffixes=('', ''))
+
+    balance_sheet_df = pd.pivot_table(bs_balances, index=level_of_detail, values='Balance', columns=get_period_comparison(comparison_by, time_grain),
+                                      aggfunc='sum', observed=True)
+    return balance_sheet_df, get_calculated_labels(bs_structure, HIERARCHY_COLUMNS)
+
+
+@memoize_statement
+def build_cash_flow_values(data_version, time_grain='Year', query_backend=QUERY_BACKEND):
+    """
+    Applies the cash flow value types to every account, territory and period, before any filter.
+
+    The value types look across periods (opening balances, movements), so this does not depend on
+    the sidebar filters and is computed once per data version and time grain.
+    """
+    workbook_data = _load_workbook_data(*data_version)
+    cf_structure = prepare_statement_structure(workbook_data['CF Structure'], workbook_data['COA'], ['SubType'])
+    cf_index = ['Type', 'SubType_SortKey', 'SubTypeLabel', 'ValueType', 'Region', 'Country', 'Sign', 'Account']
+    periods = get_calendar_periods(workbook_data['Calendar'], time_grain) if time_grain != 'Year' else None
+    # the cube keeps positive and negative postings apart in its Sign column
+    if query_backend == 'duckdb':
+        cf_gl_cube = query_statement_totals(data_version, 'GL_Cube', cf_structure, ([], [], []), cf_index + ['Year' if periods is None else 'Period_SortKey'],
+                                            'Amount', periods, time_grain)
+    else:
+        cf_gl_cube = pd.merge(workbook_data['GL_Cube'], cf_structure, left_on='Account_key', right_on='Account_key', how='inner', suffixes=('', ''))
+        if periods is not None:
+            cf_gl_cube = pd.merge(cf_gl_cube, periods, on=TIME_GRAINS[time_grain], how='inner', suffixes=('', ''))
+
+    if periods is not None:
+        # a period without postings is a zero movement, so the running balances carry through it
+        cash_flow_df = pd.pivot_table(cf_gl_cube, index=cf_index, values='Amount', columns='Period_SortKey', aggfunc='sum', observed=True, fill_value=0
+                                      ).sort_values(by=['SubType_SortKey'], ascending=True)
+        period_keys = sorted(cash_flow_df.columns)
+        transformed_cf_df = transform_cash_flow_values(cash_flow_df.reset_index(), period_keys)
+        cash_flow_values = pd.melt(transformed_cf_df, id_vars=cf_index, value_vars=period_keys, var_name='Period_SortKey', value_name='Amount')
+        return pd.merge(cash_flow_values, periods, on='Period_SortKey', how='inner', suffixes=('', ''))
+
+    # the running balances need the years in chronological order, whatever order the ledger is in
+    cash_flow_df = pd.pivot_table(cf_gl_cube, index=cf_index, values='Amount', columns='Year', aggfunc='sum', observed=True, fill_value=0
+                                  ).sort_values(by=['SubType_SortKey'], ascending=True)
+    cash_flow_df = cash_flow_df.reset_index()
+    years = sorted(column for column in cash_flow_df.columns if column not in cf_index)
+
+    transformed_cf_df = transform_cash_flow_values(cash_flow_df, years)
+    return pd.melt(transformed_cf_df, id_vars=cf_index, value_vars=years, var_name='Year', value_name='Amount')
+
+
+@memoize_statement
+def build_cash_flow_statement(data_version, filters, comparison_by, time_grain='Year', query_backend=QUERY_BACKEND):
+    """
+    Builds the cash flow statement pivot for the selected filters, comparison columns and time grain.
+
+    Returns:
+    - tuple: (cash flow statement, calculated labels for `print_df_to_dashboard`).
+    """
+    workbook_data = _load_workbook_data(*data_version)
+    cf_structure = prepare_statement_structure(workbook_data['CF Structure'], workbook_data['COA'], ['SubType'])
+
+    filtered_cf = apply_global_filters(build_cash_flow_values(data_version, time_grain, query_backend), *filters)
+    cash_flow_statement_df = pd.pivot_table(filtered_cf, index=['Type', 'SubType_SortKey', 'SubTypeLabel'], values=['Amount'], columns=get_period_comparison(comparison_by, time_grain),
+                                            aggfunc='sum', observed=True
+                                 ).sort_values(by=['SubType_SortKey'], ascending=True)
+    return cash_flow_statement_df, get_calculated_labels(cf_structure, ['SubType'])
+
+
+@memoize_statement
+def build_measures(data_version, region, country, time_grain='Year'):
+    """
+    Computes the base measures and ratios for every period of a time grain with a MeasureEngine.
+
+    Returns:
+    - tuple: (DataFrame with one row per period and one column per measure or ratio, the unit of each column).
+    """
+    workbook_data = _load_workbook_data(*data_version)
+    periods = get_calendar_periods(workbook_data['Calendar'], time_grain)
+    engine = MeasureEngine(workbook_data['GL_Cube'], workbook_data['COA'], region, country, workbook_data['GL_Cube_filter_index'], TIME_GRAINS[time_grain], periods)
+    return engine.values, engine.units
+
+
+def import_duckdb():
+    try:
+        import duckdb
+    except ImportError as error:
+        raise ImportError("ACCVIZ_QUERY_BACKEND=duckdb needs the duckdb package: pip install duckdb") from error
+    return duckdb
+
+
+@st.cache_resource(max_entries=2)
+def get_duckdb_connection(data_version):
+    """
+    Opens an in-memory DuckDB database holding the GL cube and balances.
+
+    The tables are loaded once per data version from Arrow and the connection is shared by every
+    session; each query runs on its own cursor.
+    """
+    duckdb = import_duckdb()
+    workbook_data = _load_workbook_data(*data_version)
+    connection = duckdb.connect()
+    for table in ['GL_Cube', 'GL_Balances']:
+        connection.register('source_table', pa.Table.from_pandas(workbook_data[table], preserve_index=False))
+        connection.execute(f"CREATE TABLE {quote_identifier(table)} AS SELECT * FROM source_table")
+        connection.unregister('source_table')
+    return connection
+
+
+def quote_identifier(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+@track_stage('duckdb_query')
+def query_statement_totals(data_version, table, structure, filters, group_columns, value_column='Amount', periods=None, time_grain='Year'):
+    """
+    Filters a GL table, joins a statement structure and sums value_column by group_columns in DuckDB.
+
+    This is the SQL counterpart of `apply_global_filters`, the structure merge and the group-by
+    that `pd.pivot_table` does: only one row per statement line and column comes back, with the
+    categorical dtypes of the source columns restored so the pivot orders its rows and columns
+    as the pandas path does.
+
+    Parameters:
+    - data_version (tuple): The output of `get_data_version`.
+    - table (str or pd.DataFrame): 'GL_Cube' or 'GL_Balances', or a DataFrame to query instead (e.g. period balances).
+    - structure (pd.DataFrame): The statement structure from `prepare_statement_structure`.
+    - filters (tuple): The (year, region, country) sidebar selections.
+    - group_columns (list): Columns of the result, from the table, the structure or the periods.
+    - value_column (str): The column to sum.
+    - periods (pd.DataFrame): The `get_calendar_periods` of a finer time grain to join on its TIME_GRAINS columns, or None.
+
+    Returns:
+    - pd.DataFrame: group_columns and the summed value_column.
+    """
+    fact = _load_workbook_data(*data_version)[table] if isinstance(table, str) else table
+    cursor = get_duckdb_connection(data_version).cursor()
+    try:
+        if isinstance(table, str):
+            source = quote_identifier(table)
+        else:
+            cursor.register('statement_fact', pa.Table.from_pandas(fact, preserve_index=False))
+            source = 'statement_fact'
+        cursor.register('statement_structure', pa.Table.from_pandas(structure, preserve_index=False))
+        joins = 'JOIN statement_structure USING ("Account_key")'
+        if periods is not None:
+            cursor.register('statement_periods', pa.Table.from_pandas(periods, preserve_index=False))
+            joins += f" JOIN statement_periods USING ({', '.join(quote_identifier(column) for column in TIME_GRAINS[time_grain])})"
+
+        conditions, parameters = [], []
+        for column, values in zip(['Year', 'Region', 'Country'], filters):
+            if len(values):
+                conditions.append(f"{quote_identifier(column)} IN ({', '.join('?' * len(values))})")
+                parameters += [value.item() if hasattr(value, 'item') else value for value in values]
+        where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+        columns = ', '.join(quote_identifier(column) for column in group_columns)
+        query = f"SELECT {columns}, SUM({quote_identifier(value_column)}) AS {quote_identifier(value_column)} FROM {source} {joins} {where} GROUP BY {columns}"
+        totals = cursor.execute(query, parameters).df()
+    finally:
+        cursor.close()
+
+    for column in group_columns:
+        source_frame = next(frame for frame in [fact, structure, periods] if frame is not None and column in frame.columns)
+        totals[column] = totals[column].astype(source_frame[column].dtype)
+    return totals
+
+
+@track_stage()
+def get_statement_cube(data_version, structure_name, filters):
+    """
+    Filters the GL cube with the sidebar selections and attaches a statement structure's row labels.
+    """
+    workbook_data = _load_workbook_data(*data_version)
+    filtered_gl_cube = apply_global_filters(workbook_data['GL_Cube'], *filters, filter_index=workbook_data['GL_Cube_filter_index'])
+    structure = prepare_statement_structure(workbook_data[structure_name], workbook_data['COA'], HIERARCHY_COLUMNS)
+    return pd.merge(filtered_gl_cube, structure, left_on='Account_key', right_on='Account_key', how='inner', suffixes=('', ''))
+
+
+def estimate_tokens(text):
+    """
+    Approximates the number of tokens in a text at about four characters per token.
+    """
+    return (len(text) + 3) // 4
+
+
+def format_compact_amount(value):
+    if pd.isna(value):
+        return '-'
+    for scale, suffix in ((1e9, 'B'), (1e6, 'M'), (1e3, 'k')):
+        if abs(value) >= scale:
+            return f"{value / scale:,.2f}{suffix}"
+    return f"{value:,.0f}"
+
+
+def format_change(current, prior, unit=''):
+    """
+    Formats the change from prior to current: a percentage for amounts, a difference for ratios.
+    """
+    if pd.isna(current) or pd.isna(prior):
+        return '-'
+    if unit:
+        return ('+' if current >= prior else '') + format_measure(current - prior, unit)
+    if prior == 0:
+        return '-'
+    return f"{(current - prior) / abs(prior) * 100:+,.1f}%"
+
+
+def render_context_section(title, lines, periods, prior_periods, token_budget):
+    """
+    Renders a statement summary as compact text lines that fit in a token budget.
+
+    The oldest periods are dropped first; if the latest period alone is still too long, the
+    remaining lines are cut and the number omitted is noted.
+
+    Parameters:
+    - title (str): The section heading.
+    - lines (list): (label, {period: value}, unit) for each summary line; unit is '' for amounts.
+    - periods (list): The period labels, in date order.
+    - prior_periods (dict): The same period a year earlier for each period label, for the YoY change of the latest period.
+    - token_budget (int): The approximate number of tokens the section may take.
+
+    Returns:
+    - str: The section text.
+    """
+    latest = periods[-1] if periods else None
+    prior = prior_periods.get(latest)
+
+    def render_line(label, values, unit, shown):
+        text = '; '.join(f"{period} {format_measure(values.get(period), unit) if unit else format_compact_amount(values.get(period))}" for period in shown)
+        if prior is not None:
+            text += f"; YoY {format_change(values.get(latest), values.get(prior), unit)}"
+        return f"- {label}: {text}"
+
+    for count in range(len(periods), 0, -1):
+        rendered = [f"#### {title}"] + [render_line(*line, periods[-count:]) for line in lines]
+        if estimate_tokens('\n'.join(rendered)) <= token_budget:
+            return '\n'.join(rendered)
+    if not periods:
+        return f"#### {title}\n- no data for the selected filters"
+
+    kept = rendered[:1]
+    for line in rendered[1:]:
+        if estimate_tokens('\n'.join(kept + [line, '- ... 999 more lines omitted'])) > token_budget:
+            break
+        kept.append(line)
+    return '\n'.join(kept + [f"- ... {len(rendered) - len(kept)} more lines omitted"])
+
+
+@memoize_statement
+def build_llm_context(data_version, statement, filters, time_grain='Year', token_budget=LLM_CONTEXT_TOKENS):
+    """
+    Summarizes a statement for the LLM question form in at most about token_budget tokens.
+
+    The summary has the statement's top-level lines and totals for each period, with the change
+    on the same period a year earlier, instead of the full pivot. With a Year filter, the year
+    before each selected year is built too, for that change, and left out of the summary. It is
+    built from the memoized statements and memoized itself, per data version, filters, time grain
+    and budget.
+
+    Parameters:
+    - data_version (tuple): The output of `get_data_version`.
+    - statement (str): 'Income Statement', 'Balance Sheet', 'Cash Flow' or 'Key Ratios'.
+    - filters (tuple): The (year, region, country) sidebar selections.
+    - time_grain (str): A TIME_GRAINS key.
+    - token_budget (int): The approximate number of tokens the summary may take.
+
+    Returns:
+    - str: The summary, headed by the statement name.
+    """
+    workbook_data = _load_workbook_data(*data_version)
+    selected_years = list(filters[0])
+    if selected_years:
+        filters = (sorted(set(selected_years) | {year - 1 for year in selected_years}), *filters[1:])
+    if statement == 'Income Statement':
+        statement_df, _ = build_income_statement(data_version, filters, get_hierarchy_index(['SubClass']), ['Year'], time_grain)
+        # an empty pivot has no margins
+        statement_df = statement_df.drop(columns='Total', errors='ignore')
+    elif statement == 'Balance Sheet':
+        statement_df, _ = build_balance_sheet(data_version, filters, get_hierarchy_index(['SubClass2']), ['Year'], time_grain)
+    elif statement == 'Cash Flow':
+        statement_df, _ = build_cash_flow_statement(data_version, filters, ['Year'], time_grain)
+        statement_df = statement_df['Amount']
+    elif statement == 'Key Ratios':
+        values, units = build_measures(data_version, filters[1], filters[2], time_grain)
+        if filters[0]:
+            values = values[values.index.get_level_values('Year').isin(filters[0])]
+        statement_df = values[list(RATIOS)].T
+    else:
+        raise ValueError(f"unknown statement {statement!r}")
+    if statement_df.empty:
+        return f"#### {statement}\n- no data for the selected filters"
+
+    periods = [' '.join(map(str, column)) if isinstance(column, tuple) else str(column) for column in statement_df.columns]
+    statement_df = statement_df.set_axis(periods, axis=1)
+    labels = statement_df.index.get_level_values(-1).astype('str')
+    if statement_df.index.nlevels > 2:
+        # repeated labels such as 'Total' are named after their section instead
+        labels = labels.where(~labels.duplicated(keep=False), statement_df.index.get_level_values(0).astype('str'))
+    lines = [(label, row.to_dict(), units[label] if statement == 'Key Ratios' else '') for label, (_, row) in zip(labels, statement_df.iterrows())]
+
+    calendar_periods = get_calendar_periods(workbook_data['Calendar'], time_grain)
+    period_labels = calendar_periods['Period'].astype('str').tolist()
+    periods_per_year = int(calendar_periods.groupby('Year').size().max())
+    prior_periods = dict(zip(period_labels[periods_per_year:], period_labels))
+    # period labels start with their year ('2020', '2020 Qtr 1')
+    shown_periods = [period for period in periods if not selected_years or int(period.split(' ')[0]) in selected_years]
+    return render_context_section(statement, lines, shown_periods, prior_periods, token_budget)
 
 
 def stylize(value, style='shortened_currency'):
@@ -218,14 +2245,514 @@ def plot_comparison_chart_with_traces(comparison_by, dataframe, y_column_name):
     # Display the plot in Streamlit
     st.plotly_chart(fig, use_container_width=True)
 
-@st.cache_data
-def ask_from_llm(query, model="gemini"):
-    if len(query) > 0:
+
+class GeminiBackend:
+    """
+    Streams answers from a Google Gemini model.
+    """
+
+    def __init__(self, model=LLM_MODEL):
+        self.name = 'gemini'
+        self.model = model
+
+    def stream(self, prompt, timeout=LLM_TIMEOUT):
         genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
-        # print(query)
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        response = model.generate_content(query)
-        # print("received response")
-        return response.text
+        response = genai.GenerativeModel(self.model).generate_content(prompt, stream=True, request_options={'timeout': timeout})
+        for chunk in response:
+            yield chunk.text
+
+
+class LocalLLMBackend:
+    """
+    Deterministic offline stand-in for a model, for load tests and development without an API key.
+
+    The answer only depends on the prompt, and is streamed a word at a time with an optional
+    delay per word to simulate a model's latency.
+    """
+
+    def __init__(self, model='local', delay=LLM_LOCAL_DELAY):
+        self.name = 'local'
+        self.model = model
+        self.delay = delay
+
+    def stream(self, prompt, timeout=LLM_TIMEOUT):
+        digest = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        question = prompt.rsplit('### question:', 1)[-1].strip(' \n#')
+        words = f"Local answer {digest[:8]} to: {question or 'an empty question'} ({len(prompt):,} prompt characters)".split(' ')
+        for position, word in enumerate(words):
+            if self.delay:
+                time.sleep(self.delay)
+            yield word if position == 0 else ' ' + word
+
+
+# LLM_BACKEND values and the classes that serve them; a new backend only needs `name`, `model` and `stream(prompt, timeout)`
+LLM_BACKENDS = {
+    'gemini': GeminiBackend,
+    'local': LocalLLMBackend,
+}
+
+
+class LLMResponseCache:
+    """
+    Persistent cache of LLM answers keyed on a hash of the backend, model and prompt.
+
+    Answers live in a SQLite file, so they survive restarts and are shared by every server
+    process using the same file. Entries older than ttl seconds are not served; the least
+    recently used ones are evicted once there are more than max_entries or they take more
+    than max_bytes.
+    """
+
+    def __init__(self, path=LLM_CACHE_PATH, ttl=LLM_CACHE_TTL, max_entries=LLM_CACHE_MAX_ENTRIES, max_bytes=LLM_CACHE_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute("""CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY, backend TEXT, model TEXT, response TEXT,
+                size INTEGER, created_at REAL, used_at REAL)""")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # one short-lived connection per call, so the cache can be used from any thread; it commits (or rolls back) and is closed on exit
+        with contextlib.closing(sqlite3.connect(self.path, timeout=30)) as connection:
+            with connection:
+                yield connection
+
+    @staticmethod
+    def get_key(backend, model, prompt):
+        return hashlib.sha256('\0'.join([backend, model, prompt]).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._connect() as connection:
+            row = connection.execute('SELECT response FROM responses WHERE key = ? AND created_at >= ?', (key, now - self.ttl)).fetchone()
+            if row is not None:
+                connection.execute('UPDATE responses SET used_at = ? WHERE key = ?', (now, key))
+        return None if row is None else row[0]
+
+    def put(self, key, backend, model, response):
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (key, backend, model, response, len(response.encode('utf-8')), now, now))
+            self._evict(connection, now)
+
+    def _evict(self, connection, now):
+        connection.execute('DELETE FROM responses WHERE created_at < ?', (now - self.ttl,))
+        # keep the most recently used entries that fit in both limits
+        connection.execute("""DELETE FROM responses WHERE key IN (
+            SELECT key FROM (
+                SELECT key, ROW_NUMBER() OVER (ORDER BY used_at DESC) AS position,
+                       SUM(size) OVER (ORDER BY used_at DESC ROWS UNBOUNDED PRECEDING) AS total_size
+                FROM responses)
+            WHERE position > ? OR (total_size > ? AND position > 1))""", (self.max_entries, self.max_bytes))
+
+    def stats(self):
+        with self._connect() as connection:
+            entries, size = connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        return {'entries': entries, 'size_mb': size / 2**20}
+
+    def clear(self):
+        with self._connect() as connection:
+            connection.execute('DELETE FROM responses')
+
+
+class LLMService:
+    """
+    Answers prompts with an LLM backend, through the persistent response cache.
+
+    Answers are streamed as the backend produces them; a cached answer is returned as a single
+    chunk. A backend that goes more than timeout seconds without producing the next chunk raises
+    TimeoutError. Concurrent requests for the same uncached prompt wait for the first one and are
+    answered from the cache, so the backend is asked once. Latency (over the last
+    LLM_LATENCY_SAMPLES requests) and cache hit counters are kept for the sidebar and the load test.
+    """
+
+    def __init__(self, backend, cache=None, timeout=LLM_TIMEOUT):
+        self.backend = backend
+        self.cache = cache
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=LLM_LATENCY_SAMPLES)
+        self._lock = threading.Lock()
+        # prompt key -> [lock held while the backend answers it, number of requests waiting on it]
+        self._in_flight = {}
+
+    def stream_answer(self, prompt):
+        """
+        Yields the answer to a prompt in chunks, from the cache or the backend.
+        """
+        if not prompt:
+            return
+        started = time.perf_counter()
+        key = LLMResponseCache.get_key(self.backend.name, self.backend.model, prompt)
+        cached = self.cache.get(key) if self.cache is not None else None
+        if cached is not None:
+            self._record(started, hit=True)
+            yield cached
+            return
+        if self.cache is None:
+            yield from self._stream_from_backend(key, prompt, started)
+            return
+
+        with self._single_flight(key):
+            # another request for the same prompt may have been answered while this one waited
+            cached = self.cache.get(key)
+            if cached is not None:
+                self._record(started, hit=True)
+                yield cached
+                return
+            yield from self._stream_from_backend(key, prompt, started)
+
+    def ask(self, prompt):
+        return ''.join(self.stream_answer(prompt))
+
+    @contextlib.contextmanager
+    def _single_flight(self, key):
+        with self._lock:
+            entry = self._in_flight.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._in_flight[key]
+
+    def _stream_from_backend(self, key, prompt, started):
+        chunks = []
+        try:
+            for chunk in self._stream_with_timeout(prompt):
+                chunks.append(chunk)
+                yield chunk
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+        self._record(started, hit=False)
+        # only complete answers are cached, so an interrupted or failed stream is asked again next time
+        if self.cache is not None:
+            self.cache.put(key, self.backend.name, self.backend.model, ''.join(chunks))
+
+    def _stream_with_timeout(self, prompt):
+        # the backend runs on its own thread so a stalled request cannot block the script past the timeout
+        chunks = queue.Queue()
+        done = object()
+
+        def produce():
+            try:
+                for chunk in self.backend.stream(prompt, self.timeout):
+                    chunks.put(chunk)
+                chunks.put(done)
+            except Exception as error:
+                chunks.put(error)
+
+        threading.Thread(target=produce, daemon=True).start()
+        while True:
+            try:
+                chunk = chunks.get(timeout=self.timeout)
+            except queue.Empty:
+                raise TimeoutError(f"{self.backend.name} did not answer within {self.timeout:g}s")
+            if chunk is done:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    def _record(self, started, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.latencies.append(time.perf_counter() - started)
+
+    def stats(self):
+        with self._lock:
+            latencies = np.array(self.latencies)
+            requests = self.hits + self.misses
+            return {
+                'backend': self.backend.name,
+                'requests': requests,
+                'hits': self.hits,
+                'misses': self.misses,
+                'errors': self.errors,
+                'hit_rate': self.hits / requests if requests else 0.0,
+                'p50_ms': float(np.percentile(latencies, 50)) * 1000 if len(latencies) else 0.0,
+                'p95_ms': float(np.percentile(latencies, 95)) * 1000 if len(latencies) else 0.0,
+            }
+
+
+def create_llm_service(backend=LLM_BACKEND, cache_path=LLM_CACHE_PATH, timeout=LLM_TIMEOUT):
+    """
+    Creates an LLMService for one of the LLM_BACKENDS, caching its answers in cache_path (no cache when None).
+    """
+    if backend not in LLM_BACKENDS:
+        raise ValueError(f"unknown LLM backend {backend!r}; expected one of {sorted(LLM_BACKENDS)}")
+    cache = LLMResponseCache(cache_path) if cache_path else None
+    return LLMService(LLM_BACKENDS[backend](), cache, timeout)
+
+
+@st.cache_resource
+def get_llm_service():
+    return create_llm_service()
+
+
+def ask_from_llm(query, model=LLM_BACKEND):
+    """
+    Returns the whole answer to a query; use `get_llm_service().stream_answer` to stream it instead.
+    """
+    if len(query) > 0:
+        service = get_llm_service() if model == LLM_BACKEND else create_llm_service(model)
+        return service.ask(query)
     else:
-        return ""
\ No newline at end of file
+        return ""
+
+
+def run_llm_load_test(service, requests, distinct_prompts, workers=8):
+    """
+    Sends `requests` questions drawn from `distinct_prompts` different prompts through an LLMService from a thread pool.
+
+    Returns:
+    - dict: The service's stats after the run, with the wall time and throughput added.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    rng = np.random.default_rng(0)
+    prompts = [f"### context: \nload test\n\n### question: \nQuestion {number} about the ledger ###" for number in rng.integers(0, distinct_prompts, requests)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(service.ask, prompts))
+    elapsed = time.perf_counter() - started
+    return {**service.stats(), 'seconds': elapsed, 'requests_per_second': requests / elapsed}
+
+
+# statements a batch report can include, by their command-line name
+REPORT_STATEMENTS = {
+    'pnl': 'Income Statement',
+    'bs': 'Balance Sheet',
+    'cf': 'Cash Flow Statement',
+}
+REPORT_FORMATS = ('xlsx', 'parquet', 'csv')
+
+
+def get_report_filters(workbook_data, by=['Region', 'Country', 'Year']):
+    """
+    Lists the filter combinations of a batch report: one per combination of the `by` columns that has postings.
+
+    Returns:
+    - list: (name, (year, region, country)) pairs; a single unfiltered report when by is empty.
+    """
+    if not by:
+        return [('All', ([], [], []))]
+    combinations = workbook_data['GL_Cube'][by].drop_duplicates().sort_values(by)
+    report_filters = []
+    for values in combinations.itertuples(index=False):
+        selected = dict(zip(by, values))
+        filters = tuple([selected[column]] if column in selected else [] for column in ['Year', 'Region', 'Country'])
+        report_filters.append(('_'.join(re.sub(r'[^\w.-]+', '-', str(value)) for value in values), filters))
+    return report_filters
+
+
+def build_report_statements(data_version, filters, statements=list(REPORT_STATEMENTS), level_of_detail=['Class', 'SubClass', 'SubClass2'], time_grain='Year'):
+    """
+    Builds the statements of one batch report with the same builders as the dashboard.
+
+    Returns:
+    - dict: A statement pivot with display labels for each REPORT_STATEMENTS name requested.
+    """
+    hierarchy_index = get_hierarchy_index(level_of_detail)
+    reports = {}
+    if 'pnl' in statements:
+        reports['pnl'], _ = build_income_statement(data_version, filters, hierarchy_index, ['Year'], time_grain)
+    if 'bs' in statements:
+        reports['bs'], _ = build_balance_sheet(data_version, filters, hierarchy_index, ['Year'], time_grain)
+    if 'cf' in statements:
+        reports['cf'], _ = build_cash_flow_statement(data_version, filters, ['Year'], time_grain)
+    return {REPORT_STATEMENTS[statement]: format_statement_index(report) for statement, report in reports.items()}
+
+
+def flatten_report(report):
+    """
+    Turns a statement pivot into a flat table with string column names, for Parquet and CSV.
+    """
+    columns = [' '.join(str(part) for part in column if part != 'Amount') if isinstance(column, tuple) else str(column) for column in report.columns]
+    return report.set_axis(columns, axis=1).reset_index()
+
+
+def write_report(reports, output_path, output_format='xlsx'):
+    """
+    Writes the statements of one batch report: one workbook with a sheet per statement for
+    'xlsx', or one file per statement in the output_path folder for 'parquet' and 'csv'.
+
+    Returns:
+    - str: The workbook or folder written.
+    """
+    if output_format == 'xlsx':
+        output_path += '.xlsx'
+        with pd.ExcelWriter(output_path) as writer:
+            for name, report in reports.items():
+                report.to_excel(writer, sheet_name=name)
+        return output_path
+
+    os.makedirs(output_path, exist_ok=True)
+    for name, report in reports.items():
+        path = os.path.join(output_path, name.replace(' ', '_') + '.' + output_format)
+        if output_format == 'parquet':
+            flatten_report(report).to_parquet(path, index=False)
+        else:
+            flatten_report(report).to_csv(path, index=False)
+    return output_path
+
+
+def _init_report_worker(data_version):
+    # only the parent process writes the stage log; the workers keep their records in memory
+    pipeline_stages.disable_log()
+    # each worker opens the memory-mapped cache once, so the GL pages are shared read-only between processes
+    _load_workbook_data(*data_version)
+
+
+def _run_report_task(data_version, name, filters, statements, level_of_detail, time_grain, output_dir, output_format):
+    started = time.perf_counter()
+    reports = build_report_statements(data_version, filters, statements, level_of_detail, time_grain)
+    output_path = write_report(reports, os.path.join(output_dir, name), output_format)
+    return name, output_path, time.perf_counter() - started
+
+
+def run_batch_report(data_version, by=['Region', 'Country', 'Year'], statements=list(REPORT_STATEMENTS), output_dir='reports', output_format='xlsx',
+                     workers=None, level_of_detail=['Class', 'SubClass', 'SubClass2'], time_grain='Year', progress=print):
+    """
+    Builds and writes a batch report for every filter combination of the `by` columns, across a process pool.
+
+    The cache is loaded (and rebuilt if needed) once in this process before the workers start;
+    each worker then memory-maps the same cached tables, builds its share of the reports and
+    writes them itself, so only file names and timings come back.
+
+    Parameters:
+    - data_version (tuple): The output of `get_data_version`.
+    - by (list): Columns among 'Region', 'Country' and 'Year' to split the reports by.
+    - statements (list): REPORT_STATEMENTS names to include.
+    - output_dir (str): Folder to write the reports to.
+    - output_format (str): One of REPORT_FORMATS.
+    - workers (int): Number of processes; None for one per CPU, 0 to build in this process.
+    - progress (callable): Called with a progress line after each report; None for no output.
+
+    Returns:
+    - list: (name, output path, seconds) for each report, in the order they finished.
+    """
+    if output_format not in REPORT_FORMATS:
+        raise ValueError(f"unknown report format {output_format!r}; expected one of {REPORT_FORMATS}")
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    report_filters = get_report_filters(_load_workbook_data(*data_version), by)
+    os.makedirs(output_dir, exist_ok=True)
+    task_options = (statements, level_of_detail, time_grain, output_dir, output_format)
+
+    results = []
+    def record(result):
+        results.append(result)
+        if progress:
+            progress(f"[{len(results)}/{len(report_filters)}] {result[0]} -> {result[1]} ({result[2]:.2f}s)")
+
+    if workers == 0:
+        for name, filters in report_filters:
+            record(_run_report_task(data_version, name, filters, *task_options))
+        return results
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_report_worker, initargs=(data_version,)) as executor:
+        futures = [executor.submit(_run_report_task, data_version, name, filters, *task_options) for name, filters in report_filters]
+        for future in as_completed(futures):
+            record(future.result())
+    return results
+
+
+def check_query_backend(data_version=None, backend='duckdb', time_grains=list(TIME_GRAINS), level_of_detail=['Class', 'SubClass', 'SubClass2']):
+    """
+    Builds every statement with the pandas path and with `backend` and compares the results.
+
+    Covers the unfiltered statements and one filter combination per region, country and year,
+    each with the default and the Country comparison columns. The backend is passed to the
+    builders, so it is part of their cache keys and the app's configured backend is untouched.
+
+    Returns:
+    - list: (statement, filters, time grain, comparison, error) for every mismatch; empty when the backends agree.
+    """
+    data_version = data_version or get_data_version()
+    workbook_data = _load_workbook_data(*data_version)
+    filter_sets = [([], [], [])] + [filters for by in [['Region'], ['Country'], ['Year']] for _, filters in get_report_filters(workbook_data, by)]
+    hierarchy_index = get_hierarchy_index(level_of_detail)
+    builders = {
+        'Income Statement': lambda *case: build_income_statement(data_version, case[0], hierarchy_index, *case[1:])[0],
+        'Balance Sheet': lambda *case: build_balance_sheet(data_version, case[0], hierarchy_index, *case[1:])[0],
+        'Cash Flow Statement': lambda *case: build_cash_flow_statement(data_version, *case)[0],
+    }
+    cases = [(statement, filters, time_grain, comparison_by) for statement in builders for time_grain in time_grains
+             for comparison_by in [['Year'], ['Year', 'Country']] for filters in filter_sets]
+
+    results = {query_backend: [builders[statement](filters, comparison_by, time_grain, query_backend) for statement, filters, time_grain, comparison_by in cases]
+               for query_backend in ['pandas', backend]}
+
+    mismatches = []
+    for case, expected, result in zip(cases, results['pandas'], results[backend]):
+        try:
+            pd.testing.assert_frame_equal(result, expected, check_exact=False, rtol=1e-9)
+        except AssertionError as error:
+            mismatches.append((*case, str(error)))
+    return mismatches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='AccViz data utilities')
+    parser.add_argument('command', choices=['rebuild-cache', 'append-batches', 'llm-load-test', 'report', 'check-backend'])
+    parser.add_argument('--file', default=DATA_FILE_PATH, help='workbook to load')
+    parser.add_argument('--gl-source', default=GL_SOURCE_PATH, help='CSV or Parquet GL export to read instead of the GL sheet')
+    parser.add_argument('--batch-dir', default=GL_BATCH_DIR, help='folder of GL batch files to append to the cache')
+    parser.add_argument('--chunk-size', type=int, default=GL_CHUNK_SIZE, help='stream the GL in chunks of this many rows')
+    parser.add_argument('--backend', default='local', choices=sorted(LLM_BACKENDS), help='LLM backend for llm-load-test')
+    parser.add_argument('--llm-cache', default=LLM_CACHE_PATH, help='response cache file for llm-load-test')
+    parser.add_argument('--requests', type=int, default=1000, help='questions sent by llm-load-test')
+    parser.add_argument('--distinct-prompts', type=int, default=100, help='different questions among them')
+    parser.add_argument('--by', default='Region,Country,Year', help='comma-separated columns to split the reports by (Region, Country, Year)')
+    parser.add_argument('--statements', default=','.join(REPORT_STATEMENTS), help='comma-separated statements to include (pnl, bs, cf)')
+    parser.add_argument('--level-of-detail', default='Class,SubClass,SubClass2', help='comma-separated hierarchy columns of the report rows')
+    parser.add_argument('--time-grain', default='Year', choices=list(TIME_GRAINS), help='period columns of the reports')
+    parser.add_argument('--format', default='xlsx', choices=REPORT_FORMATS, help='report file format')
+    parser.add_argument('--output-dir', default='reports', help='folder to write the reports to')
+    parser.add_argument('--query-backend', default='duckdb', choices=QUERY_BACKENDS, help='backend check-backend compares with the pandas path')
+    parser.add_argument('--workers', type=int, default=None, help='report processes; defaults to one per CPU, 0 builds in this process')
+    args = parser.parse_args()
+
+    started = time.time()
+    if args.command == 'report':
+        data_version = get_data_version(args.file, args.gl_source, args.batch_dir, args.chunk_size)
+        split = lambda option: [value for value in option.split(',') if value]
+        results = run_batch_report(data_version, split(args.by), split(args.statements), args.output_dir, args.format,
+                                   args.workers, split(args.level_of_detail), args.time_grain)
+        print(f"{len(results)} reports written to {args.output_dir} in {time.time() - started:.2f}s")
+        sys.exit()
+    if args.command == 'check-backend':
+        data_version = get_data_version(args.file, args.gl_source, args.batch_dir, args.chunk_size)
+        mismatches = check_query_backend(data_version, args.query_backend, level_of_detail=[value for value in args.level_of_detail.split(',') if value])
+        for statement, filters, time_grain, comparison_by, error in mismatches:
+            print(f"{statement} {filters} {time_grain} {comparison_by}: {error}")
+        print(f"{args.query_backend} {'matches' if not mismatches else 'differs from'} the pandas path ({len(mismatches)} mismatches) in {time.time() - started:.2f}s")
+        sys.exit(1 if mismatches else 0)
+    if args.command == 'llm-load-test':
+        print(json.dumps(run_llm_load_test(create_llm_service(args.backend, args.llm_cache), args.requests, args.distinct_prompts), indent=2))
+        sys.exit()
+    if args.command == 'rebuild-cache':
+        rebuild_data_cache(args.file, args.gl_source, args.chunk_size)
+    elif not is_cache_valid(args.file, args.gl_source, args.batch_dir):
+        parser.error(f"the cache for {args.file} is out of date; run rebuild-cache first")
+    appended = append_new_gl_batches(args.file, args.batch_dir, args.chunk_size)
+
+    row_counts = read_cache_manifest(args.file)['row_counts']
+    print(f"Cache for {args.file}: {row_counts['GL_Master']:,} GL rows, {len(appended)} batches appended in {time.time() - started:.2f}s")